@@ -0,0 +1,154 @@
+import subprocess
+import sys
+
+import numpy as np
+
+'''Beat tracking for syncing a video to a song, without external tools besides FFMPEG.
+
+The audio is streamed out of ffmpeg in chunks, so memory use doesn't depend on the length of the song;
+only the onset envelope (one number per 512 samples) is kept for the whole song.
+
+1. Onset envelope: spectral flux of the log-magnitude STFT, i.e. how much louder each frequency bin got since the previous frame.
+2. Tempo: the autocorrelation peak of the onset envelope, weighted towards start_bpm.
+3. Beats: dynamic programming (Ellis, "Beat Tracking by Dynamic Programming", 2007), picking the sequence of onsets
+   that scores highest while keeping the gaps close to the tempo's period.
+
+Usage example:
+>>> beats = beat_times("02 Don't Shake.wav")
+>>> tl.set_beat_indices(beats)
+
+Or from the command line, to print the beat times:
+	python3 ./beat_tracker.py song.wav
+'''
+
+DEFAULT_SAMPLE_RATE = 22050
+DEFAULT_N_FFT = 2048
+DEFAULT_HOP = 512
+
+
+def read_audio_chunks(path, sr=DEFAULT_SAMPLE_RATE, chunk_seconds=10):
+    """
+    Decode any file ffmpeg understands to mono float32 at sr, yielding chunk_seconds of samples at a time.
+    """
+    command = ["ffmpeg", "-v", "error", "-i", path, "-f", "f32le", "-ac", "1", "-ar", str(sr), "-"]
+    # ffmpeg only writes errors to stderr at this log level, so it can't fill the pipe while we read stdout.
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    chunk_bytes = 4 * int(sr * chunk_seconds)
+    try:
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            # A read can end mid-sample at the end of the stream.
+            data = data[:len(data) - len(data) % 4]
+            yield np.frombuffer(data, dtype=np.float32)
+        if process.wait() != 0:
+            raise RuntimeError("ffmpeg could not decode {0}: {1}".format(
+                path, process.stderr.read().decode("utf-8", "replace").strip()))
+    finally:
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+
+
+def onset_envelope(chunks, n_fft=DEFAULT_N_FFT, hop=DEFAULT_HOP, compression=100):
+    """
+    Spectral-flux onset strength, one value per hop samples, from an iterable of sample arrays.\n
+    Frames are centered, i.e. value t describes the audio around sample t * hop.
+    """
+    window = np.hanning(n_fft).astype(np.float32)
+    # Pad the start so that the first frame is centered on sample 0.
+    buffer = np.zeros(n_fft // 2, dtype=np.float32)
+    prev_spectrum = None
+    flux = []
+    for chunk in chunks:
+        buffer = np.concatenate([buffer, chunk])
+        n_frames = 1 + (len(buffer) - n_fft) // hop if len(buffer) >= n_fft else 0
+        if n_frames == 0:
+            continue
+        frames = np.lib.stride_tricks.sliding_window_view(buffer, n_fft)[:n_frames * hop:hop]
+        spectrum = np.log1p(compression * np.abs(np.fft.rfft(frames * window, axis=1)))
+        if prev_spectrum is None:
+            prev_spectrum = spectrum[:1]
+        diffs = np.diff(np.concatenate([prev_spectrum, spectrum]), axis=0)
+        flux += [np.maximum(diffs, 0).sum(axis=1)]
+        prev_spectrum = spectrum[-1:]
+        # Keep only the samples the next frame still needs.
+        buffer = buffer[n_frames * hop:]
+    if not flux:
+        return np.zeros(0)
+    return np.concatenate(flux)
+
+
+def estimate_tempo(envelope, fps, start_bpm=120, std_octaves=1.0, min_bpm=30, max_bpm=300):
+    """
+    Tempo in beats per minute: the strongest autocorrelation lag of the onset envelope,
+    weighted by a log-normal prior centered on start_bpm so that half/double tempos are only picked if clearly stronger.
+    """
+    env = envelope - envelope.mean()
+    n = 1 << int(np.ceil(np.log2(2 * len(env))))
+    spectrum = np.fft.rfft(env, n)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), n)[:len(env)]
+    lags = np.arange(1, len(autocorrelation))
+    bpms = 60.0 * fps / lags
+    valid = (bpms >= min_bpm) & (bpms <= max_bpm)
+    weights = np.exp(-0.5 * (np.log2(bpms / start_bpm) / std_octaves) ** 2)
+    scores = np.where(valid, autocorrelation[1:] * weights, -np.inf)
+    return bpms[np.argmax(scores)]
+
+
+def track_beats(envelope, fps, bpm, tightness=100):
+    """
+    Frame indices of the beats, by dynamic programming over the onset envelope.\n
+    tightness sets how strongly gaps between beats are held to the tempo's period.
+    """
+    period = 60.0 * fps / bpm
+    env = envelope / (envelope.std() + 1e-10)
+    # Smooth the onsets slightly so that beats can land just off an onset peak.
+    gaussian_x = np.arange(-int(period), int(period) + 1)
+    local_score = np.convolve(env, np.exp(-0.5 * (gaussian_x * 32.0 / period) ** 2), mode="same")
+    # Possible predecessors lie between half a period and two periods back.
+    offsets = np.arange(-int(np.round(2 * period)), -int(np.round(period / 2)) + 1)
+    penalty = -tightness * np.log(-offsets / period) ** 2
+    scores = np.zeros(len(env))
+    backlinks = -np.ones(len(env), dtype=int)
+    for t in range(len(env)):
+        candidates = t + offsets
+        in_range = candidates >= 0
+        scores[t] = local_score[t]
+        if np.any(in_range):
+            candidate_scores = scores[candidates[in_range]] + penalty[in_range]
+            best = np.argmax(candidate_scores)
+            if candidate_scores[best] > 0:
+                scores[t] += candidate_scores[best]
+                backlinks[t] = candidates[in_range][best]
+    # Backtrace from the best-scoring frame near the end, ignoring the fade-out.
+    tail = int(np.ceil(period))
+    last = len(env) - tail + np.argmax(scores[-tail:]) if len(env) > tail else int(np.argmax(scores))
+    beats = [last]
+    while backlinks[beats[-1]] >= 0:
+        beats += [backlinks[beats[-1]]]
+    beats = np.array(beats[::-1])
+    # Drop beats in silent lead-ins and tails, where the DP just keeps counting.
+    threshold = np.median(local_score) + 0.5 * local_score.std()
+    strong = np.where(local_score[beats] > threshold)[0]
+    if len(strong):
+        beats = beats[strong[0]:strong[-1] + 1]
+    return beats
+
+
+def beat_times(path, sr=DEFAULT_SAMPLE_RATE, n_fft=DEFAULT_N_FFT, hop=DEFAULT_HOP, start_bpm=120, tightness=100):
+    """
+    Beat times, in seconds, of an audio file. Ready to pass to timeline.set_beat_indices.
+    """
+    envelope = onset_envelope(read_audio_chunks(path, sr), n_fft=n_fft, hop=hop)
+    if len(envelope) < 2:
+        raise ValueError("No audio decoded from {0}".format(path))
+    fps = 1.0 * sr / hop
+    bpm = estimate_tempo(envelope, fps, start_bpm=start_bpm)
+    print("Estimated tempo: {0:.1f} BPM".format(bpm))
+    return track_beats(envelope, fps, bpm, tightness=tightness) / fps
+
+
+if __name__ == "__main__":
+    print(np.round(beat_times(sys.argv[1]), 2).tolist())
@@ -0,0 +1,44 @@
+'''Startup-time benchmark for the street_crawl CLI.
+
+Runs each command in a fresh interpreter several times and reports the median wall time, e.g.:
+	python3 ./benchmarks/bench_startup.py --repeat 20
+
+The cheap stages should stay in the tens of milliseconds: if one of these numbers jumps, something heavy
+(googlemaps, polyline, pandas, API_KEYS) has crept back into a module-level import.
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    "python (baseline)": [sys.executable, "-c", "pass"],
+    "import street_crawl": [sys.executable, "-c", "import street_crawl"],
+    "street_crawl.py --help": [sys.executable, "street_crawl.py", "--help"],
+    "street_crawl.py lineup --help": [sys.executable, "street_crawl.py", "lineup", "--help"],
+}
+
+
+def time_command(command, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=REPO_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings += [time.perf_counter() - start]
+    return statistics.median(timings)
+
+
+def main(repeat):
+    for name, command in COMMANDS.items():
+        print("{0:<32} {1:8.1f} ms".format(name, 1000 * time_command(command, repeat)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    main(parser.parse_args().repeat)
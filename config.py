@@ -0,0 +1,60 @@
+'''Settings shared by the street_crawl stages and utils.
+
+Kept free of third-party imports so that loading it (and therefore running `street_crawl.py --help`)
+stays cheap, and so that utils no longer has to import street_crawl to find these constants.
+'''
+
+import json
+import os
+
+DEFAULT_STREETVIEW_PHOTO_FOLDER = "./photos/"
+DEFAULT_PHOTO_EXTENSION = ".jpg"
+DEFAULT_VIDEO_OUTPUT_FOLDER = "./video/"
+DEFAULT_PICSIZE = "640x640"
+# Thumbnails are used to probe, dedupe and plan; only frames that survive are fetched at DEFAULT_PICSIZE.
+# They share the photo folder's naming (and metadata .json files) but live in a subfolder,
+# so line-up only ever sees full-resolution images.
+DEFAULT_THUMBNAIL_PICSIZE = "160x160"
+DEFAULT_THUMBNAIL_FOLDER = DEFAULT_STREETVIEW_PHOTO_FOLDER + "thumbs/"
+DEFAULT_HOP_SIZE = 10
+# Routes are resampled by arc length (see utils.resample_path) at this many frames per km on average,
+# denser in turns and sparser on straight stretches.
+DEFAULT_FRAMES_PER_KM = 60
+# Point this at a local fake server (e.g. one that injects 429s) to exercise the throttling in throttle.py for free.
+STREETVIEW_BASE_URL = os.environ.get("STREETVIEW_BASE_URL", "https://maps.googleapis.com/maps/api/streetview")
+# Billable Street View image requests allowed per day (metadata requests are free and not counted); None for no limit.
+DEFAULT_DAILY_BUDGET = 25000
+DEFAULT_BUDGET_FILE = "./.streetview_budget.json"
+DEFAULT_THREADS = 8
+# Seconds to wait on a stalled Street View connection before giving up and retrying it.
+DEFAULT_REQUEST_TIMEOUT = 30
+
+
+def route_file(filestem):
+    # Look points written by the "route" stage and read by every later stage.
+    return "./{0}_route.json".format(filestem)
+
+
+def load_route(filestem):
+    with open(route_file(filestem)) as reader:
+        return [tuple(pt) for pt in json.load(reader)]
+
+
+def queue_file(filestem):
+    # SQLite work queue shared by the "enqueue" and "work" stages; see work_queue.py.
+    return "./{0}_queue.sqlite".format(filestem)
+
+
+def lineup_dir(filestem):
+    return "./lineup-{0}/".format(filestem)
+
+
+def build_dir(filestem):
+    # Encoded segments kept between "render --incremental" runs; see incremental.py.
+    return DEFAULT_VIDEO_OUTPUT_FOLDER + "build-{0}/".format(filestem)
+
+
+def load_api_keys():
+    # Imported on demand, so stages that never talk to Google don't need an API_KEYS.py at all.
+    from API_KEYS import API_KEY_DIRECTIONS, API_KEY_STREETVIEW
+    return API_KEY_DIRECTIONS, API_KEY_STREETVIEW
@@ -0,0 +1,124 @@
+import itertools
+import os
+import threading
+from queue import PriorityQueue
+
+from config import DEFAULT_STREETVIEW_PHOTO_FOLDER, DEFAULT_PHOTO_EXTENSION
+from utils import download_streetview_image
+
+
+class ImageRef(object):
+    """
+    A reference to an itinerary image that may not have been downloaded yet.\n
+    Timelines hold these instead of filenames; the file is only fetched once something schedules it,
+    and resolve() blocks until the background downloader has written it.
+    """
+
+    def __init__(self, itinerary_index, filestem, folder=DEFAULT_STREETVIEW_PHOTO_FOLDER):
+        self.itinerary_index = itinerary_index
+        self.filestem = filestem
+        self.path = folder + "{0}_{1}".format(filestem, itinerary_index) + DEFAULT_PHOTO_EXTENSION
+        self.error = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return "ImageRef({0})".format(self.path)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def mark_done(self, error=None):
+        self.error = error
+        self._done.set()
+
+    def resolve(self, timeout=None):
+        if self.exists():
+            return self.path
+        if not self._done.wait(timeout):
+            raise TimeoutError("Timed out waiting for {0}".format(self.path))
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+
+class FetchQueue(object):
+    """
+    Priority queue of ImageRefs drained by background threads.\n
+    Lower priorities are fetched first; timelines use the first frame that shows an image,
+    so the start of the video becomes available while later images are still downloading.
+    fetch_function(ref) must write ref.path.
+    """
+
+    def __init__(self, fetch_function, n_workers=1):
+        self.fetch_function = fetch_function
+        self.n_workers = n_workers
+        self.queue = PriorityQueue()
+        self.threads = []
+        # Tie-breaker so that refs themselves never need to be compared.
+        self._counter = itertools.count()
+
+    def submit(self, priority, ref):
+        self.queue.put((priority, next(self._counter), ref))
+
+    def start(self):
+        for _ in range(self.n_workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads += [thread]
+        return self
+
+    def close(self):
+        # One sentinel per worker, sorting after every real item.
+        for _ in self.threads:
+            self.queue.put((float("inf"), next(self._counter), None))
+
+    def join(self):
+        self.close()
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            _, _, ref = self.queue.get()
+            if ref is None:
+                return
+            if ref.exists():
+                ref.mark_done()
+                continue
+            try:
+                self.fetch_function(ref)
+            except Exception as e:
+                print("Failed to fetch {0}: {1}".format(ref.path, e))
+                ref.mark_done(e)
+            else:
+                ref.mark_done()
+
+
+def itinerary_fetcher(itinerary, apikey_streetview, picsize="640x640"):
+    """
+    Build a fetch_function for FetchQueue that downloads the itinerary row an ImageRef points at.\n
+    pandas isn't thread-safe, so the dataframe is only touched while holding a lock (but not during the download).
+    """
+    lock = threading.Lock()
+
+    def fetch(ref):
+        with lock:
+            row = itinerary.loc[ref.itinerary_index]
+            lat_lon, heading = (row['lat'], row['lon']), row['heading']
+        download_streetview_image(apikey_streetview, lat_lon, ref.path, heading=heading, picsize=picsize)
+        with lock:
+            itinerary.loc[ref.itinerary_index, "downloaded_1"] = True
+
+    return fetch
+
+
+def fetch_plan(refs_by_frame):
+    """
+    Given the image shown at each frame (None or '' for empty frames), return (first_frame, ref) pairs
+    for each distinct image, ordered by the first frame that uses it.
+    """
+    first_use = {}
+    for frame, ref in enumerate(refs_by_frame):
+        if isinstance(ref, ImageRef) and ref.path not in first_use:
+            first_use[ref.path] = (frame, ref)
+    return sorted(first_use.values(), key=lambda item: item[0])
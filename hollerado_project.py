@@ -21,7 +21,15 @@
 #
 
 # Imports
+import googlemaps
+import numpy as np
+import pandas as pd
+import polyline
 from utils import *
+from fetching import ImageRef, FetchQueue, itinerary_fetcher, fetch_plan
+from beat_tracker import beat_times
+from incremental import render_incremental
+from config import build_dir
 from API_KEYS import API_KEY_DIRECTIONS, API_KEY_STREETVIEW
 import pickle
 
@@ -83,9 +91,13 @@ itin_bd["dist_from_2018-07"] = np.max((months_before, months_after), axis=0)
 #
 #
 
-# The following array was estimated using madmom from the audio file.
-# That work isn't replicated here. Just the output.
-beats = np.array([  0.25,   0.86,   1.52,   2.14,   2.81,   3.42,   4.08,   4.69,
+# The song. Its beats are estimated with beat_tracker (spectral-flux onsets + dynamic programming).
+song_filename = "/Users/jordan/Music/iTunes/iTunes Music/Hollerado/Born Yesterday/02 Don't Shake.wav"
+
+# The following array was estimated using madmom from the audio file, and is what define_program was written against
+# (its beat numbers go up to 647 half-beats). It's used whenever the song isn't available, or when the tracker
+# counts a different number of beats, since the program would then no longer line up with the song.
+madmom_beats = np.array([  0.25,   0.86,   1.52,   2.14,   2.81,   3.42,   4.08,   4.69,
          5.36,   5.96,   6.62,   7.24,   7.91,   8.52,   9.18,   9.8 ,
         10.47,  11.07,  11.73,  12.35,  13.02,  13.63,  14.29,  14.91,
         15.58,  16.19,  16.85,  17.47,  18.14,  18.74,  19.4 ,  20.01,
@@ -127,6 +139,26 @@ beats = np.array([  0.25,   0.86,   1.52,   2.14,   2.81,   3.42,   4.08,   4.69
        199.39, 200.02, 200.67, 201.3 , 201.94, 202.57, 203.22, 203.84,
        204.49, 205.11, 205.77, 206.39])
 
+
+def load_beats(tolerance=0.05):
+    # define_program below is written against these 324 madmom beats of this one song, so the beat tracker can only
+    # check and fine-tune them here. For a new song, start from beat_tracker.beat_times and write a new program.
+    if not os.path.isfile(song_filename):
+        print("Song not found; using the madmom beats.")
+        return madmom_beats
+    tracked_beats = beat_times(song_filename)
+    nearest = tracked_beats[np.argmin(np.abs(madmom_beats[:, None] - tracked_beats[None, :]), axis=1)]
+    offsets = np.abs(nearest - madmom_beats)
+    if np.median(offsets) > tolerance:
+        print("Tracked beats don't line up with the madmom beats (median offset {0:.3f}s); using the madmom beats.".format(
+            np.median(offsets)))
+        return madmom_beats
+    # Keep the madmom beat grid, which the program counts on, but take the tracker's timing where the two agree.
+    return np.where(offsets <= tolerance, nearest, madmom_beats)
+
+
+beats = load_beats()
+
 tmp_half_beats = beats[:-1] + (beats[1:] - beats[:-1])/2
 halfbeats = np.array(sorted(list(tmp_half_beats) + list(beats)))
 
@@ -135,13 +167,21 @@ halfbeats = np.array(sorted(list(tmp_half_beats) + list(beats)))
 
 class timeline(object):
     def __init__(self, duration, fps=24, new_stem="default_stem", base_path="./photos"):
-        self.timeline = pd.DataFrame(columns=['time','beatindex','filename'])
+        self.timeline = pd.DataFrame(columns=['time','beatindex','image'])
         self.timeline.time = np.arange(0,duration,1.0/fps)
         self.timeline.beatindex = np.zeros(self.timeline.shape[0]).astype(int)
         self.timeline = self.timeline.fillna("")
         self.fps = fps
         self.new_stem = new_stem
         self.base_path = base_path
+        self.refs = {}
+    
+    def image_ref(self, itinerary_index, stem="bd_1000s"):
+        # Share one ImageRef per image, so every frame showing it waits on the same download.
+        key = (stem, itinerary_index)
+        if key not in self.refs:
+            self.refs[key] = ImageRef(itinerary_index, stem)
+        return self.refs[key]
     
     def set_beat_indices(self, beat_times_seconds):
         nearest_frames_to_beats = [np.argmin(np.abs(self.timeline.time - b)) for b in beat_times_seconds]
@@ -149,50 +189,83 @@ class timeline(object):
         cumulative_beat_index[nearest_frames_to_beats] = 1
         self.timeline["beatindex"] = np.cumsum(cumulative_beat_index).astype(int)
     
-    def set_pic_to_beat(self, pic_filename, beat1, beat2=None):
+    def set_pic_to_beat(self, pic_ref, beat1, beat2=None):
         if beat2 is None:
             beat2 = beat1 + 1
-        self.timeline["filename"][(self.timeline.beatindex>=beat1) & (self.timeline.beatindex<beat2)] = pic_filename
+        frames = self.timeline.index[(self.timeline.beatindex>=beat1) & (self.timeline.beatindex<beat2)]
+        for frame in frames:
+            self.timeline.at[frame, "image"] = pic_ref
     
-    def set_continuous_pics_from_beat(self, pic_filenames, beat1, beat2):
+    def set_continuous_pics_from_beat(self, pic_refs, beat1, beat2):
         start_index = self.timeline.index[self.timeline.beatindex==beat1].values[0]
         end_index = self.timeline.index[self.timeline.beatindex==beat2].values[0]
         range_len = end_index-start_index
-        self.timeline['filename'][start_index:end_index] = pic_filenames[:range_len]
+        for frame, pic_ref in zip(range(start_index, end_index), pic_refs):
+            self.timeline.at[frame, "image"] = pic_ref
         return range_len
     
+    def fetch_plan(self):
+        return fetch_plan(self.timeline["image"].values)
+    
     def copy_images_in_timeline(self):
+        # Walk the frames in order, waiting on each image only when it is first needed,
+        # so the early part of the video is lined up while later images are still downloading.
         for ind in self.timeline.index:
-            old_filename = self.timeline.loc[ind]['filename']
+            pic_ref = self.timeline.loc[ind]['image']
             new_filename = "{0}/{1}{2}.jpg".format(self.base_path, self.new_stem, ind)
-            if old_filename is not '':
+            if isinstance(pic_ref, ImageRef):
+                try:
+                    old_filename = pic_ref.resolve()
+                except Exception as e:
+                    print("Skipping frame {0}: {1}".format(ind, e))
+                    continue
                 print("{0} {1} {2}".format("cp", old_filename, new_filename))
                 os.system("{0} {1} {2}".format("cp", old_filename, new_filename))
     
-    def script_make_video(self):
+    def frame_files(self):
+        # Yield the image file for each frame, in order, waiting for each download only when its frame comes up;
+        # None where there is no image.
+        for pic_ref in self.timeline['image'].values:
+            try:
+                yield pic_ref.resolve() if isinstance(pic_ref, ImageRef) else None
+            except Exception as e:
+                print("Skipping {0}: {1}".format(pic_ref, e))
+                yield None
+    
+    def section_boundaries(self, beats_per_section=16):
+        # Start a new segment every beats_per_section (half-)beats, so that changing the plan for one part
+        # of the song only re-encodes that part.
+        sections = self.timeline.beatindex.values // beats_per_section
+        return [0] + list(np.where(np.diff(sections) != 0)[0] + 1)
+    
+    def script_make_video(self, incremental=False):
         video_filename = self.new_stem + "vid"
         sound_filename = self.new_stem + "vid_sound"
-        make_video(self.new_stem, video_string=video_filename,basepath=self.base_path)
-        os.system("ffmpeg -i {0}.mp4 -i \"/Users/jordan/Music/iTunes/iTunes Music/Hollerado/Born Yesterday/02 Don't Shake.wav\" -shortest {1}.mp4 -y".format(video_filename, sound_filename))
+        if incremental:
+            # Reads the images in place (no copy_images_in_timeline needed) and only re-encodes changed sections.
+            # Each section is encoded as soon as its images are downloaded, while later ones are still being fetched.
+            # Without incremental, make_video only starts once copy_images_in_timeline has every image.
+            render_incremental(self.frame_files(), video_filename + ".mp4", build_dir(self.new_stem),
+                               fps=self.fps, boundaries=self.section_boundaries())
+        else:
+            make_video(self.new_stem, video_string=video_filename,basepath=self.base_path)
+        os.system("ffmpeg -i {0}.mp4 -i \"{1}\" -shortest {2}.mp4 -y".format(video_filename, song_filename, sound_filename))
         print("Video should have been successfully made here: {0}".format(sound_filename))
 
 
-def download_missing_items_for_timeline(timeline_obj, itinerary, stem="bd_1000s"):
-    missing_ids = []
-    for fn in timeline_obj.timeline["filename"].values:
-        # Check if it exists.
-        if not os.path.exists(fn):
-            folder = os.path.dirname(fn)
-            filename = os.path.basename(fn)
-            basename, ext = os.path.splitext(filename)
-            index = int(basename.split(stem)[1])
-            missing_ids += [index]
-    print("For this route, there are {0} images to download.".format(len(missing_ids)))
-    continue_opt = raw_input('Would you like to download them all Type yes to proceed; otherwise, program halts.\n')
+def start_fetching_for_timeline(timeline_obj, itinerary, picsize="640x640", n_workers=2):
+    # Only images the timeline actually references are queued, earliest frame first.
+    plan = [(frame, ref) for frame, ref in timeline_obj.fetch_plan() if not ref.exists()]
+    print("For this route, there are {0} images to download.".format(len(plan)))
+    continue_opt = input('Would you like to download them all Type yes to proceed; otherwise, program halts.\n')
     if continue_opt not in ['Yes','yes']:
-        return
-    download_pics_from_list(itinerary, API_KEY_STREETVIEW, stem, "640x640", redownload=False, index_filter=missing_ids)
-    return itinerary
+        for frame, ref in plan:
+            ref.mark_done(FileNotFoundError(ref.path))
+        return None
+    fetch_queue = FetchQueue(itinerary_fetcher(itinerary, API_KEY_STREETVIEW, picsize), n_workers=n_workers)
+    for frame, ref in plan:
+        fetch_queue.submit(frame, ref)
+    return fetch_queue.start()
 
 # Construct a plan for the song, deciding, for each range of sub-beats (2 ticks per beat),
 # whether to assign one picture for the entire beat or one picture per frame of video.
@@ -304,18 +377,18 @@ for beat_i in range(0,647):
     if beat_i in leap_onsets:
         eligible_pic_ind += 50
     if beat_i in pic_per_2_beats:
-        tl.set_pic_to_beat("./photos/bd_1000s{0}.jpg".format(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+2)
+        tl.set_pic_to_beat(tl.image_ref(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+2)
         eligible_pic_ind += 1*current_pace
     elif beat_i in pic_per_4_beats:
-        tl.set_pic_to_beat("./photos/bd_1000s{0}.jpg".format(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+4)
+        tl.set_pic_to_beat(tl.image_ref(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+4)
         eligible_pic_ind += 1*current_pace
     elif beat_i in pic_per_1_beat:
-        tl.set_pic_to_beat("./photos/bd_1000s{0}.jpg".format(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+1)
+        tl.set_pic_to_beat(tl.image_ref(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+1)
         eligible_pic_ind += 1*current_pace
     elif beat_i in pic_per_1_frame:
-        pic_filenames = ["./photos/bd_1000s{0}.jpg".format(itinerary_ids[ep_ind]) for ep_ind in range(eligible_pic_ind,len(itinerary_ids))]
-        pace_pic_filenames = [pic_filenames[i] for i in range(0,len(pic_filenames),current_pace)]
-        range_len = tl.set_continuous_pics_from_beat(pace_pic_filenames, beat_i, beat_i+1)
+        # Lazily generated, so only the refs that land on a frame are ever created.
+        pace_pic_refs = (tl.image_ref(itinerary_ids[ep_ind]) for ep_ind in range(eligible_pic_ind,len(itinerary_ids),current_pace))
+        range_len = tl.set_continuous_pics_from_beat(pace_pic_refs, beat_i, beat_i+1)
         eligible_pic_ind = eligible_pic_ind + range_len*current_pace
 
 eligible_pic_ind_at_647 = eligible_pic_ind
@@ -341,27 +414,33 @@ for beat_i in range(480,647):
     if beat_i in leap_onsets:
         eligible_pic_ind += 50
     if beat_i in pic_per_2_beats:
-        tl.set_pic_to_beat("./photos/bd_1000s{0}.jpg".format(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+2)
+        tl.set_pic_to_beat(tl.image_ref(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+2)
         eligible_pic_ind += 1*current_pace
     elif beat_i in pic_per_4_beats:
-        tl.set_pic_to_beat("./photos/bd_1000s{0}.jpg".format(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+4)
+        tl.set_pic_to_beat(tl.image_ref(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+4)
         eligible_pic_ind += 1*current_pace
     elif beat_i in pic_per_1_beat:
-        tl.set_pic_to_beat("./photos/bd_1000s{0}.jpg".format(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+1)
+        tl.set_pic_to_beat(tl.image_ref(itinerary_ids[eligible_pic_ind]), beat_i, beat_i+1)
         eligible_pic_ind += 1*current_pace
     elif beat_i in pic_per_1_frame:
-        pic_filenames = ["./photos/bd_1000s{0}.jpg".format(itinerary_ids[ep_ind]) for ep_ind in range(eligible_pic_ind,len(itinerary_ids))]
-        pace_pic_filenames = [pic_filenames[i] for i in range(0,len(pic_filenames),current_pace)]
-        range_len = tl.set_continuous_pics_from_beat(pace_pic_filenames, beat_i, beat_i+1)
+        # Lazily generated, so only the refs that land on a frame are ever created.
+        pace_pic_refs = (tl.image_ref(itinerary_ids[ep_ind]) for ep_ind in range(eligible_pic_ind,len(itinerary_ids),current_pace))
+        range_len = tl.set_continuous_pics_from_beat(pace_pic_refs, beat_i, beat_i+1)
         eligible_pic_ind = eligible_pic_ind + range_len*current_pace
 
 
-# Final steps: make sure all the pics are downloaded,
-# copy pictures into proper sequence,
-# then make the video using ffmpeg.
-itin_bd_copy = download_missing_items_for_timeline(tl, itin_bd, stem="bd_1000s")
-tl.copy_images_in_timeline()
-tl.script_make_video()
+# Final steps: queue the pictures the timeline uses for download (earliest frames first),
+# then make the video using ffmpeg as they arrive.
+# The incremental build reads the pictures in place and, when re-run after tweaking the program or
+# deleting a bad picture, only re-encodes the sections that changed. The full build needs the
+# pictures copied into proper sequence first.
+fetch_queue = start_fetching_for_timeline(tl, itin_bd)
+incremental = True
+if not incremental:
+    tl.copy_images_in_timeline()
+tl.script_make_video(incremental=incremental)
+if fetch_queue is not None:
+    fetch_queue.join()
 
 # Preserve output!
 itin_bd.to_pickle("new_pickled_filename.p")
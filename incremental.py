@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+'''Incremental video builds.
+
+Instead of lining up (renumbering) every image and re-encoding the whole movie, the frames are split into segments,
+each segment is encoded on its own, and the segments are joined with ffmpeg's concat demuxer without re-encoding.
+Each segment's artifact is named after a hash of everything that goes into it (the contents of its frames, the frame
+rate and the encoder settings), so on the next build only segments whose inputs changed are encoded again.
+
+Segment boundaries are either given (e.g. every few bars of a song's beat grid), or chosen from the content of the
+frames themselves, so that deleting one bad image only changes the segment it was in rather than shifting every
+boundary after it.
+
+Usage example:
+>>> render_incremental(["./photos/joshua_tree_0.jpg", "./photos/joshua_tree_3.jpg", ...], "./video/joshua_tree.mp4",
+...                    "./video/build-joshua_tree/", fps=1, vf=INTERPOLATE_30FPS)
+'''
+
+DEFAULT_ENCODE_ARGS = ["-vcodec", "libx264", "-crf", "23", "-pix_fmt", "yuv420p"]
+# Same interpolation filter as utils.make_video.
+INTERPOLATE_30FPS = "framerate=fps=30:interp_start=1:interp_end=254:scene=5"
+
+
+def file_digest(path, cache):
+    # Re-hash a file only if its size or modification time changed since the last build.
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    stamp = [stat.st_size, stat.st_mtime]
+    if key not in cache or cache[key][0] != stamp:
+        with open(path, 'rb') as reader:
+            cache[key] = [stamp, hashlib.sha1(reader.read()).hexdigest()]
+    return cache[key][1]
+
+
+def content_defined_boundaries(digests, target_length=48, min_length=None, max_length=None):
+    """
+    Start a new segment at any frame whose (new) image hash is 0 modulo target_length, so boundaries depend on
+    the images around them and not on their position in the video. Segments are kept between min_length and max_length frames.
+    """
+    if min_length is None:
+        min_length = max(1, target_length // 4)
+    if max_length is None:
+        max_length = 4 * target_length
+    boundaries = [0]
+    for i in range(1, len(digests)):
+        length = i - boundaries[-1]
+        # A held image (the same digest on consecutive frames) only gets one chance to start a segment.
+        is_cut = digests[i] != digests[i - 1] and int(digests[i], 16) % target_length == 0
+        if length >= max_length or (length >= min_length and is_cut):
+            boundaries += [i]
+    return boundaries
+
+
+def drop_repeats(frames, digests):
+    # Same effect as utils.prune_repeated_images_from_list, but comparing hashes instead of running diff.
+    keepers = [i for i in range(len(frames)) if i == 0 or digests[i] != digests[i - 1]]
+    return [frames[i] for i in keepers], [digests[i] for i in keepers]
+
+
+def segment_hash(digests, fps, vf, encode_args):
+    settings = json.dumps({"fps": fps, "vf": vf, "encode_args": encode_args}, sort_keys=True)
+    return hashlib.sha1((settings + "\n" + "\n".join(digests)).encode("utf-8")).hexdigest()
+
+
+def encode_segment(frames, segment_path, fps, vf, encode_args, duration=None):
+    # image2 needs consecutively numbered files, so link the frames into a scratch folder in order.
+    # The originals are never renamed. With duration (in seconds), the output is cut short there.
+    scratch_dir = segment_path + ".frames"
+    if os.path.exists(scratch_dir):
+        shutil.rmtree(scratch_dir)
+    os.makedirs(scratch_dir)
+    extension = os.path.splitext(frames[0])[1]
+    for i, frame in enumerate(frames):
+        link = os.path.join(scratch_dir, "{0}{1}".format(i, extension))
+        try:
+            os.symlink(os.path.abspath(frame), link)
+        except OSError:
+            shutil.copyfile(frame, link)
+    command = ["ffmpeg", "-v", "error", "-f", "image2", "-framerate", str(fps),
+               "-i", os.path.join(scratch_dir, "%d" + extension)] + encode_args
+    if vf:
+        command += ["-vf", vf]
+    if duration is not None:
+        command += ["-t", str(duration)]
+    command += [segment_path + ".tmp.mp4", "-y"]
+    try:
+        subprocess.check_call(command)
+        os.replace(segment_path + ".tmp.mp4", segment_path)
+    finally:
+        shutil.rmtree(scratch_dir)
+
+
+def hold_empty_frames(frames):
+    """
+    Yield frames, replacing each None with the previous image (or, before the first image, with the first one).\n
+    Frames are passed on as soon as they arrive, so frames can be a generator that waits for downloads.
+    """
+    n_leading, previous = 0, None
+    for frame in frames:
+        if frame is None:
+            if previous is None:
+                n_leading += 1
+                continue
+            frame = previous
+        elif previous is None:
+            for _ in range(n_leading):
+                yield frame
+        previous = frame
+        yield frame
+    if previous is None:
+        raise ValueError("No frames to render")
+
+
+def split_frames(frames, boundaries):
+    # Group frames into segments starting at each boundary, yielding (first frame index, frames) for each segment
+    # as soon as it is complete.
+    starts = set(boundaries)
+    segment, n_frames = [], 0
+    for frame in frames:
+        if n_frames in starts and segment:
+            yield n_frames - len(segment), segment
+            segment = []
+        segment += [frame]
+        n_frames += 1
+    if segment:
+        yield n_frames - len(segment), segment
+
+
+def with_next_frame(segments, overlap):
+    """
+    Yield (start, frames, next_frame) for each segment, where next_frame is the first frame of the following segment
+    (None for the last segment, or without overlap).\n
+    Filters such as INTERPOLATE_30FPS blend each image into the next, so with a filter each segment is encoded with
+    the next segment's first frame and then cut back to its own length: the blend runs across the cut, as in a
+    video encoded in one go. Without overlap, segments are passed on as soon as they arrive.
+    """
+    previous = None
+    for start, frames in segments:
+        if not overlap:
+            yield start, frames, None
+            continue
+        if previous is not None:
+            yield previous[0], previous[1], frames[0]
+        previous = (start, frames)
+    if previous is not None:
+        yield previous[0], previous[1], None
+
+
+def render_incremental(frames, output_path, build_dir, fps=24, vf=None, boundaries=None, target_segment_length=48,
+                       encode_args=DEFAULT_ENCODE_ARGS, remove_repeats=False):
+    """
+    Make a video from a sequence of image files, one per frame, re-encoding only segments that changed since the last build.\n
+    frames may contain repeats (an image held for several frames) and None for empty frames.
+    boundaries are the frame indices at which segments start. When they are given, the frames are taken to be on a
+    fixed clock and empty frames hold the previous image. frames can then be any iterable, e.g. a generator that waits
+    for each image to download: each segment is encoded as soon as its last frame arrives.
+    Otherwise empty frames are skipped and boundaries are chosen by content_defined_boundaries, which needs every frame first.
+    With a filter (vf), each segment overlaps the next by one frame (see with_next_frame), so editing the first image of
+    a segment also re-encodes the segment before it.
+    With remove_repeats, consecutive identical images are dropped first, as line_up_files does.
+    Returns the number of segments that had to be encoded.
+    """
+    if not os.path.exists(build_dir):
+        os.makedirs(build_dir)
+    manifest_path = os.path.join(build_dir, "manifest.json")
+    manifest = {"digests": {}}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as reader:
+            manifest = json.load(reader)
+
+    if boundaries is None or remove_repeats:
+        frames = [frame for frame in frames if frame is not None]
+        if not frames:
+            raise ValueError("No frames to render")
+        digests = [file_digest(frame, manifest["digests"]) for frame in frames]
+        if remove_repeats:
+            frames, digests = drop_repeats(frames, digests)
+        segments = split_frames(frames, content_defined_boundaries(digests, target_segment_length))
+    else:
+        segments = split_frames(hold_empty_frames(frames), boundaries)
+
+    segment_paths = []
+    n_encoded = 0
+    used_frames = set()
+    for start, segment, next_frame in with_next_frame(segments, vf is not None):
+        inputs = segment + ([next_frame] if next_frame is not None else [])
+        segment_digests = [file_digest(frame, manifest["digests"]) for frame in inputs]
+        segment_path = os.path.join(build_dir, "segment_{0}.mp4".format(
+            segment_hash(segment_digests, fps, vf, encode_args)))
+        if not os.path.isfile(segment_path):
+            print("Encoding frames {0} to {1}".format(start, start + len(segment) - 1))
+            encode_segment(inputs, segment_path, fps, vf, encode_args,
+                           duration=1.0 * len(segment) / fps if next_frame is not None else None)
+            n_encoded += 1
+        segment_paths += [segment_path]
+        used_frames.update(os.path.abspath(frame) for frame in segment)
+    print("Re-encoded {0} of {1} segments".format(n_encoded, len(segment_paths)))
+
+    concat_list = os.path.join(build_dir, "segments.txt")
+    with open(concat_list, 'w') as writer:
+        writer.write("".join("file '{0}'\n".format(os.path.abspath(path)) for path in segment_paths))
+    subprocess.check_call(["ffmpeg", "-v", "error", "-f", "concat", "-safe", "0", "-i", concat_list, "-c", "copy",
+                           output_path, "-y"])
+
+    # Forget segments and images this build no longer uses, so the build folder doesn't grow forever.
+    used = set(segment_paths)
+    for name in os.listdir(build_dir):
+        path = os.path.join(build_dir, name)
+        if name.startswith("segment_") and name.endswith(".mp4") and path not in used:
+            os.remove(path)
+    manifest["digests"] = {path: value for path, value in manifest["digests"].items() if path in used_frames}
+    with open(manifest_path, 'w') as writer:
+        json.dump(manifest, writer)
+    return n_encoded
@@ -1,10 +1,11 @@
+import argparse
+import json
 import sys
 
-import googlemaps
-import polyline
-
-from API_KEYS import API_KEY_DIRECTIONS, API_KEY_STREETVIEW
-from utils import *
+# The DEFAULT_* names are re-exported here for scripts that used to import them from street_crawl.
+from config import DEFAULT_STREETVIEW_PHOTO_FOLDER, DEFAULT_PHOTO_EXTENSION, DEFAULT_VIDEO_OUTPUT_FOLDER, \
+    DEFAULT_PICSIZE, DEFAULT_THUMBNAIL_PICSIZE, DEFAULT_THREADS, DEFAULT_HOP_SIZE, DEFAULT_FRAMES_PER_KM, route_file, load_route, \
+    queue_file, lineup_dir, build_dir, load_api_keys
 
 '''Google Street View Movie Maker
 
@@ -16,6 +17,28 @@ Usage is:
 For example, to make a one-second video of the entrance of Joshua Treet National Park at a 640x640 resolution:
 	python3 ./street_crawl.py 33.669793 -115.802125 33.671796 -115.801851 joshua_tree 640x640
 
+Each stage can also be run on its own, picking up where the previous one left off:
+	python3 ./street_crawl.py route lat1 lon1 lat2 lon2 output_filestem
+	python3 ./street_crawl.py probe output_filestem
+	python3 ./street_crawl.py download output_filestem --picsize 640x640
+	python3 ./street_crawl.py download output_filestem --picsize 640x640 --ladder
+	python3 ./street_crawl.py lineup output_filestem
+	python3 ./street_crawl.py render output_filestem
+
+After deleting bad images from photos/, "render --incremental" rebuilds the video without a line-up,
+re-encoding only the few-second segments that contained them:
+	python3 ./street_crawl.py render output_filestem --incremental
+
+To spread the crawl over several processes or hosts that share this folder, replace "download" with:
+	python3 ./street_crawl.py enqueue output_filestem --shard-size 100
+	python3 ./street_crawl.py work output_filestem --processes 4
+
+Heavy dependencies (googlemaps, polyline, numpy, pandas) and the API keys are only loaded by the stages that need them,
+so e.g. re-running "lineup" after deleting bad images doesn't need API keys.
+
+With --ladder, download fetches small thumbnails for every point, drops repeated and near-empty frames,
+and only fetches full-resolution images for the frames that will end up in the line-up.
+
 Note: usage requires your own API keys. API keys should be placed in a file called API_KEYS.py, with two variables called API_KEY_DIRECTIONS and API_KEY_STREETVIEW, e.g.:
 
     ---
@@ -27,38 +50,201 @@ Note: usage requires your own API keys. API keys should be placed in a file call
 Pricing for the Street View Static API: https://developers.google.com/maps/documentation/streetview/usage-and-billing
 '''
 
-DEFAULT_STREETVIEW_PHOTO_FOLDER = "./photos/"
-DEFAULT_PHOTO_EXTENSION = ".jpg"
-DEFAULT_VIDEO_OUTPUT_FOLDER = "./video/"
+STAGES = ["route", "probe", "download", "enqueue", "work", "lineup", "render"]
 
 
-def main(lat_lon_A, lat_lon_B, filestem, picsize):
+def route(lat_lon_A, lat_lon_B, filestem, frames_per_km=DEFAULT_FRAMES_PER_KM, hop_size=None):
+    import googlemaps
+    import polyline
+    from utils import interpolate_points, clean_look_points, resample_path
+
+    api_key_directions, _ = load_api_keys()
     print("Tracing path from ({0}) to ({1})".format(lat_lon_A, lat_lon_B))
     # Request driving directions from A to B
-    gd = googlemaps.Client(key=API_KEY_DIRECTIONS)
+    gd = googlemaps.Client(key=api_key_directions)
     directions_result = gd.directions(origin=lat_lon_A, destination=lat_lon_B, mode="driving")
     # Convert driving directions into sequence of GPS points
     path_points = polyline.decode(directions_result[0]['overview_polyline']['points'])
-    dense_points = [interpolate_points(pt[0], pt[1], hop_size=10) for pt in zip(path_points[:-1], path_points[1:])]
-    look_points_rough = [item for sequence in dense_points for item in sequence]
-    # Remove unnecessary points
-    look_points = clean_look_points(look_points_rough)
+    if hop_size is None:
+        # Space points along the whole route by arc length, closer together in turns
+        look_points = resample_path(path_points, frames_per_km=frames_per_km)
+    else:
+        # Original fixed-hop interpolation of each polyline segment
+        dense_points = [interpolate_points(pt[0], pt[1], hop_size=hop_size) for pt in zip(path_points[:-1], path_points[1:])]
+        look_points_rough = [item for sequence in dense_points for item in sequence]
+        # Remove unnecessary points
+        look_points = clean_look_points(look_points_rough)
+    with open(route_file(filestem), 'w') as writer:
+        json.dump([[float(lat), float(lon)] for lat, lon in look_points], writer)
+    return look_points
+
+
+def probe(filestem, picsize=DEFAULT_PICSIZE, threads=DEFAULT_THREADS):
+    from utils import probe_images_for_path
+
+    _, api_key_streetview = load_api_keys()
+    responses = probe_images_for_path(api_key_streetview, filestem, load_route(filestem), picsize=picsize,
+                                      threads=threads)
+    n_ok = len([r for r in responses if r is not None and r['status'] == "OK" and 'Google' in r.get('copyright', '')])
+    print("{0} of {1} points have Google imagery.".format(n_ok, len(responses)))
+    return responses
+
+
+def download(filestem, picsize=DEFAULT_PICSIZE, assume_yes=False, thumbsize=None, threads=DEFAULT_THREADS):
+    from utils import download_images_for_path, download_images_for_path_laddered
+
+    _, api_key_streetview = load_api_keys()
+    look_points = load_route(filestem)
+    if not assume_yes:
+        print("For this route, there are {0} images to download.\n".format(len(look_points)))
+        continue_opt = input('Would you like to download them all Type yes to proceed; otherwise, program halts.\n')
+        if continue_opt not in ['Yes', 'yes']:
+            return False
+    # Download sequence of images (up to a limit? What's the limit in a day?)
+    if thumbsize is None:
+        download_images_for_path(api_key_streetview, filestem, look_points, picsize=picsize, threads=threads)
+    else:
+        # Screen with thumbnails first; only frames headed for the line-up are fetched at picsize.
+        download_images_for_path_laddered(api_key_streetview, filestem, look_points, picsize=picsize,
+                                          thumbsize=thumbsize, threads=threads)
+    return True
+
+
+def enqueue(filestem, picsize=DEFAULT_PICSIZE, shard_size=100):
+    from work_queue import WorkQueue
+
+    n_points = len(load_route(filestem))
+    WorkQueue(queue_file(filestem)).enqueue(n_points, shard_size, settings={"filestem": filestem, "picsize": picsize})
+    print("Split {0} points into shards of {1} in {2}".format(n_points, shard_size, queue_file(filestem)))
+
+
+def work(filestem, processes=1, lease_seconds=300, threads=DEFAULT_THREADS):
+    from work_queue import run_workers
+
+    progress = run_workers(queue_file(filestem), processes, lease_seconds=lease_seconds, threads=threads)
+    print("Shards: {0}".format(progress))
+
+
+def lineup(filestem):
+    from utils import line_up_files
+
+    # Assign images new filenames (and remove bad images)
+    line_up_files(filestem, new_dir=lineup_dir(filestem), command="cp")
+
+
+def render(filestem, incremental=False):
+    if incremental:
+        from incremental import render_incremental, INTERPOLATE_30FPS
+        from utils import sorted_photos
+
+        # Straight from photos/, skipping the line-up: only segments containing deleted or new images are re-encoded.
+        render_incremental(sorted_photos(filestem), DEFAULT_VIDEO_OUTPUT_FOLDER + filestem + ".mp4", build_dir(filestem),
+                           fps=1, vf=INTERPOLATE_30FPS, remove_repeats=True)
+        return
+    from utils import make_video
+
+    # Convert sequence of images to video
+    make_video(filestem, video_string=filestem, basepath=lineup_dir(filestem))
+
+
+def main(lat_lon_A, lat_lon_B, filestem, picsize):
+    look_points = route(lat_lon_A, lat_lon_B, filestem)
     print("For this route, there are {0} images to download.\n".format(len(look_points)))
     continue_opt = input('Would you like to download them all Type yes to proceed; otherwise, program halts.\n')
     if continue_opt not in ['Yes', 'yes']:
         return
-    # Download sequence of images (up to a limit? What's the limit in a day?)
-    download_images_for_path(API_KEY_STREETVIEW, filestem, look_points, picsize=picsize)
-    # Assign images new filenames (and remove bad images)
-    line_up_files(filestem, new_dir="./lineup-{0}/".format(filestem), command="cp")
-    # Convert sequence of images to video
-    make_video(filestem, video_string=filestem, basepath="./lineup-{0}/".format(filestem))
+    download(filestem, picsize, assume_yes=True)
+    lineup(filestem)
+    render(filestem)
 
 
 # TODO: Delete downloaded images
 
+def build_parser():
+    parser = argparse.ArgumentParser(description="Google Street View Movie Maker")
+    subparsers = parser.add_subparsers(dest="stage", metavar="stage")
+    subparsers.required = True
+
+    route_parser = subparsers.add_parser("route", help="get directions from A to B and save the look points")
+    for coord in ["lat1", "lon1", "lat2", "lon2"]:
+        route_parser.add_argument(coord, type=float)
+    route_parser.add_argument("filestem")
+    route_parser.add_argument("--frames-per-km", type=float, default=DEFAULT_FRAMES_PER_KM,
+                              help="average number of look points per km; turns get more, straight roads fewer")
+    route_parser.add_argument("--hop-size", type=float, default=None,
+                              help="use the old fixed spacing instead, with this many meters between look points "
+                                   "(e.g. {0})".format(DEFAULT_HOP_SIZE))
+
+    probe_parser = subparsers.add_parser("probe", help="download Street View metadata for each look point")
+    probe_parser.add_argument("filestem")
+    probe_parser.add_argument("--picsize", default=DEFAULT_PICSIZE)
+    probe_parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                              help="requests to keep ready; the throttle adapts how many are actually in flight")
+
+    download_parser = subparsers.add_parser("download", help="download images for the look points")
+    download_parser.add_argument("filestem")
+    download_parser.add_argument("--picsize", default=DEFAULT_PICSIZE)
+    download_parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                                 help="requests to keep ready; the throttle adapts how many are actually in flight")
+    download_parser.add_argument("--yes", action="store_true", help="don't ask for confirmation")
+    download_parser.add_argument("--ladder", action="store_true",
+                                 help="fetch thumbnails for every point, and picsize only for frames that survive dedupe")
+    download_parser.add_argument("--thumbsize", default=None,
+                                 help="thumbnail size used with --ladder (default {0}); implies --ladder".format(
+                                     DEFAULT_THUMBNAIL_PICSIZE))
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="split the route into shards for distributed workers")
+    enqueue_parser.add_argument("filestem")
+    enqueue_parser.add_argument("--picsize", default=DEFAULT_PICSIZE)
+    enqueue_parser.add_argument("--shard-size", type=int, default=100)
+
+    work_parser = subparsers.add_parser("work", help="claim shards from the queue and download them")
+    work_parser.add_argument("filestem")
+    work_parser.add_argument("--processes", type=int, default=1)
+    work_parser.add_argument("--lease", type=float, default=300,
+                             help="seconds before an unfinished shard is handed to another worker")
+    work_parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                             help="requests each process keeps ready; the throttle adapts how many are actually in flight")
+
+    lineup_parser = subparsers.add_parser("lineup", help="number the downloaded images in sequence, dropping repeats")
+    lineup_parser.add_argument("filestem")
+
+    render_parser = subparsers.add_parser("render", help="make a video from the lined-up images")
+    render_parser.add_argument("filestem")
+    render_parser.add_argument("--incremental", action="store_true",
+                               help="render straight from photos/, re-encoding only the segments that changed")
+    return parser
+
+
+def run(argv):
+    args = build_parser().parse_args(argv)
+    if args.stage == "route":
+        look_points = route((args.lat1, args.lon1), (args.lat2, args.lon2), args.filestem,
+                            frames_per_km=args.frames_per_km, hop_size=args.hop_size)
+        print("For this route, there are {0} images to download.\n".format(len(look_points)))
+    elif args.stage == "probe":
+        probe(args.filestem, args.picsize, threads=args.threads)
+    elif args.stage == "download":
+        thumbsize = args.thumbsize
+        if args.ladder and thumbsize is None:
+            thumbsize = DEFAULT_THUMBNAIL_PICSIZE
+        download(args.filestem, args.picsize, assume_yes=args.yes, thumbsize=thumbsize, threads=args.threads)
+    elif args.stage == "enqueue":
+        enqueue(args.filestem, args.picsize, args.shard_size)
+    elif args.stage == "work":
+        work(args.filestem, args.processes, args.lease, threads=args.threads)
+    elif args.stage == "lineup":
+        lineup(args.filestem)
+    elif args.stage == "render":
+        render(args.filestem, incremental=args.incremental)
+
+
 if __name__ == "__main__":
-    lat_A, lon_A, lat_B, lon_B = [float(x) for x in sys.argv[1:5]]
-    filestem = sys.argv[5]
-    picsize = sys.argv[6]
-    main((lat_A, lon_A), (lat_B, lon_B), filestem, picsize)
+    if len(sys.argv) == 7 and sys.argv[1] not in STAGES:
+        # Original all-in-one usage: lat1 lon1 lat2 lon2 output_filestem picsize
+        lat_A, lon_A, lat_B, lon_B = [float(x) for x in sys.argv[1:5]]
+        filestem = sys.argv[5]
+        picsize = sys.argv[6]
+        main((lat_A, lon_A), (lat_B, lon_B), filestem, picsize)
+    else:
+        run(sys.argv[1:])
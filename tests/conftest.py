@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+# The project is a folder of scripts rather than a package, so make its modules importable from the tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+class FakeStreetView(BaseHTTPRequestHandler):
+    """
+    Street View look-alike that pushes back like the real API: above max_in_flight concurrent requests, and on every
+    throttle_every-th request regardless, it answers 429 with Retry-After (images) or OVER_QUERY_LIMIT (metadata).
+    """
+    max_in_flight = 4
+    throttle_every = 7
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.n_requests += 1
+            server.paths.append(self.path)
+            throttled = server.in_flight > self.max_in_flight or server.n_requests % self.throttle_every == 0
+        try:
+            time.sleep(0.01)
+            is_metadata = "/metadata" in self.path
+            if throttled:
+                server.counts["throttled"] += 1
+                if not is_metadata:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps({"status": "OVER_QUERY_LIMIT"}).encode("utf-8")
+            elif is_metadata:
+                body = json.dumps({"status": "OK", "copyright": "© Google"}).encode("utf-8")
+            else:
+                body = server.image_body(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def fake_streetview(tmp_path, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeStreetView)
+    server.lock = threading.Lock()
+    server.in_flight = server.n_requests = 0
+    server.counts = {"throttled": 0}
+    server.paths = []
+    # Tests can swap this out to control what each image request returns.
+    server.image_body = lambda path: b"jpeg " + path.encode("utf-8")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(utils, "STREETVIEW_BASE_URL", "http://127.0.0.1:{0}/sv".format(server.server_address[1]))
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("photos")
+    yield server
+    server.shutdown()
+    utils.set_throttle(None)
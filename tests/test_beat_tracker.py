@@ -0,0 +1,46 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from beat_tracker import onset_envelope, estimate_tempo, track_beats, beat_times, DEFAULT_SAMPLE_RATE, DEFAULT_HOP
+
+
+def click_track(n_beats=322, period=0.6, lead_in=1.0, sr=DEFAULT_SAMPLE_RATE):
+    # Short noise bursts on every beat over quiet noise: about the length of a pop song, at 100 BPM.
+    rng = np.random.RandomState(0)
+    times = lead_in + period * np.arange(n_beats)
+    audio = 0.01 * rng.randn(int((times[-1] + 2) * sr)).astype(np.float32)
+    click = (rng.randn(441) * np.exp(-np.arange(441) / 60.0)).astype(np.float32)
+    for t in times:
+        audio[int(t * sr):int(t * sr) + len(click)] += click
+    return times, audio
+
+
+def test_finds_every_beat_of_a_click_track_quickly():
+    times, audio = click_track()
+    sr = DEFAULT_SAMPLE_RATE
+    started = time.time()
+    # Fed in 10 s chunks, as read_audio_chunks does, so only the envelope is kept for the whole song.
+    envelope = onset_envelope(audio[i:i + 10 * sr] for i in range(0, len(audio), 10 * sr))
+    fps = 1.0 * sr / DEFAULT_HOP
+    bpm = estimate_tempo(envelope, fps)
+    beats = track_beats(envelope, fps, bpm) / fps
+    elapsed = time.time() - started
+    assert len(envelope) == pytest.approx(len(audio) / DEFAULT_HOP, abs=2)
+    assert bpm == pytest.approx(100, rel=0.02)
+    assert len(beats) == len(times)
+    assert np.max(np.abs(beats - times)) < 0.05
+    # A full song in a couple of seconds.
+    assert elapsed < 2
+
+
+def test_undecodable_file_names_the_file(tmp_path, monkeypatch):
+    # Stand-in for ffmpeg failing on a missing or corrupt file.
+    fake_ffmpeg = tmp_path / "ffmpeg"
+    fake_ffmpeg.write_text("#!/bin/sh\necho 'Invalid data found when processing input' >&2\nexit 1\n")
+    fake_ffmpeg.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ["PATH"])
+    with pytest.raises(RuntimeError, match="song.mp3.*Invalid data"):
+        beat_times("song.mp3")
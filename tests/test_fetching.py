@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from fetching import ImageRef, FetchQueue, fetch_plan
+
+
+def _refs(tmp_path, n):
+    return [ImageRef(i, "stem", folder=str(tmp_path) + "/") for i in range(n)]
+
+
+def test_fetch_plan_orders_distinct_refs_by_first_use(tmp_path):
+    a, b, c = _refs(tmp_path, 3)
+    plan = fetch_plan(["", b, b, None, a, b, c, a])
+    assert [(frame, ref.itinerary_index) for frame, ref in plan] == [(1, 1), (4, 0), (6, 2)]
+
+
+def test_queue_fetches_in_priority_order_once_per_ref(tmp_path):
+    refs = _refs(tmp_path, 5)
+    fetched = []
+
+    def fetch(ref):
+        fetched.append(ref.itinerary_index)
+        open(ref.path, "w").close()
+
+    fetch_queue = FetchQueue(fetch, n_workers=1)
+    for frame, ref in fetch_plan([refs[3], refs[1], refs[3], refs[4], refs[0], refs[1], refs[2]]):
+        fetch_queue.submit(frame, ref)
+    # Submitted before the worker starts, so the queue alone decides the order.
+    fetch_queue.start().join()
+    assert fetched == [3, 1, 4, 0, 2]
+    assert all(ref.resolve(timeout=1) == ref.path for ref in refs)
+
+
+def test_resolve_waits_for_download(tmp_path):
+    ref, = _refs(tmp_path, 1)
+    release = threading.Event()
+
+    def fetch(ref):
+        release.wait()
+        open(ref.path, "w").close()
+
+    fetch_queue = FetchQueue(fetch).start()
+    fetch_queue.submit(0, ref)
+    with pytest.raises(TimeoutError):
+        ref.resolve(timeout=0.05)
+    release.set()
+    assert ref.resolve(timeout=5) == ref.path
+    fetch_queue.join()
+
+
+def test_fetch_errors_are_raised_by_resolve(tmp_path):
+    good, bad = _refs(tmp_path, 2)
+
+    def fetch(ref):
+        if ref is bad:
+            raise IOError("HTTP 403")
+        open(ref.path, "w").close()
+
+    fetch_queue = FetchQueue(fetch, n_workers=2)
+    fetch_queue.submit(1, bad)
+    fetch_queue.submit(2, good)
+    fetch_queue.start().join()
+    assert good.resolve() == good.path
+    with pytest.raises(IOError, match="HTTP 403"):
+        bad.resolve()
+
+
+def test_declined_refs_fail_without_fetching(tmp_path):
+    ref, = _refs(tmp_path, 1)
+    # What start_fetching_for_timeline does when the download is declined.
+    ref.mark_done(FileNotFoundError(ref.path))
+    with pytest.raises(FileNotFoundError):
+        ref.resolve(timeout=1)
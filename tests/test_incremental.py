@@ -0,0 +1,92 @@
+import incremental
+
+
+def _fake_ffmpeg(monkeypatch):
+    # Record the frames of each encoded segment instead of running ffmpeg.
+    encoded = []
+
+    def encode_segment(frames, segment_path, fps, vf, encode_args, duration=None):
+        encoded.append(list(frames) if duration is None else list(frames)[:int(round(duration * fps))])
+        open(segment_path, "w").close()
+
+    monkeypatch.setattr(incremental, "encode_segment", encode_segment)
+    monkeypatch.setattr(incremental.subprocess, "check_call", lambda command: None)
+    return encoded
+
+
+def _images(tmp_path, n):
+    paths = []
+    for i in range(n):
+        path = tmp_path / "img_{0}.jpg".format(i)
+        path.write_text("image {0}".format(i))
+        paths.append(str(path))
+    return paths
+
+
+def test_only_changed_segments_are_reencoded(tmp_path, monkeypatch):
+    _fake_ffmpeg(monkeypatch)
+    frames = _images(tmp_path, 600)
+    build_dir = str(tmp_path / "build")
+    n_segments = incremental.render_incremental(frames, str(tmp_path / "out.mp4"), build_dir, fps=1)
+    assert n_segments > 1
+    assert incremental.render_incremental(frames, str(tmp_path / "out.mp4"), build_dir, fps=1) == 0
+    del frames[300]
+    assert incremental.render_incremental(frames, str(tmp_path / "out.mp4"), build_dir, fps=1) == 1
+
+
+def test_empty_frames_hold_previous_image_with_boundaries(tmp_path, monkeypatch):
+    encoded = _fake_ffmpeg(monkeypatch)
+    images = _images(tmp_path, 100)
+    frames = [images[i // 20] for i in range(2000)]
+    missing = list(range(0, 2000, 97))
+    for i in missing:
+        frames[i] = None
+    incremental.render_incremental(frames, str(tmp_path / "out.mp4"), str(tmp_path / "build"), fps=24,
+                                   boundaries=list(range(0, 2000, 160)))
+    rendered = [frame for segment in encoded for frame in segment]
+    assert len(rendered) == 2000
+    assert rendered[0] == images[0]
+    assert all(rendered[i] == rendered[i - 1] for i in missing[1:])
+
+
+def test_segments_are_encoded_as_frames_arrive(tmp_path, monkeypatch):
+    encoded = _fake_ffmpeg(monkeypatch)
+    images = _images(tmp_path, 10)
+    n_frames_seen = []
+
+    def frames():
+        # A frame only "arrives" once it is asked for, like frames waiting on downloads.
+        for i in range(100):
+            n_frames_seen.append(len(encoded))
+            yield images[i // 10]
+
+    incremental.render_incremental(frames(), str(tmp_path / "out.mp4"), str(tmp_path / "build"),
+                                   boundaries=[0, 25, 50, 75])
+    assert [len(segment) for segment in encoded] == [25, 25, 25, 25]
+    # Segment 0 was encoded before frame 26 was needed, and so on.
+    assert n_frames_seen[26] == 1 and n_frames_seen[51] == 2 and n_frames_seen[76] == 3
+
+
+def test_leading_empty_frames_hold_first_image(tmp_path, monkeypatch):
+    encoded = _fake_ffmpeg(monkeypatch)
+    images = _images(tmp_path, 2)
+    incremental.render_incremental(iter([None, None, images[0], None, images[1]]), str(tmp_path / "out.mp4"),
+                                   str(tmp_path / "build"), boundaries=[0])
+    assert encoded == [[images[0], images[0], images[0], images[0], images[1]]]
+
+
+def test_filtered_segments_overlap_the_next_one(tmp_path, monkeypatch):
+    calls = []
+
+    def encode_segment(frames, segment_path, fps, vf, encode_args, duration=None):
+        calls.append((list(frames), duration))
+        open(segment_path, "w").close()
+
+    monkeypatch.setattr(incremental, "encode_segment", encode_segment)
+    monkeypatch.setattr(incremental.subprocess, "check_call", lambda command: None)
+    images = _images(tmp_path, 6)
+    incremental.render_incremental(images, str(tmp_path / "out.mp4"), str(tmp_path / "build"), fps=1,
+                                   vf=incremental.INTERPOLATE_30FPS, boundaries=[0, 2, 4])
+    # Each segment is encoded with the next one's first image, so the interpolation runs across the cut,
+    # and is then trimmed to its own length.
+    assert calls == [(images[0:3], 2.0), (images[2:5], 2.0), (images[4:6], None)]
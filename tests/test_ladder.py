@@ -0,0 +1,44 @@
+import os
+from urllib.parse import urlsplit, parse_qs
+
+import street_crawl
+import throttle
+import utils
+
+
+def _query(path):
+    query = parse_qs(urlsplit(path).query)
+    lat = float(query["location"][0].split(",")[0])
+    return int(round((lat - 45.0) / 1e-4)), query["size"][0]
+
+
+def test_full_resolution_only_for_surviving_frames(fake_streetview):
+    utils.set_throttle(throttle.AdaptiveThrottle(base_delay=0.01, max_delay=0.1))
+
+    def image_body(path):
+        # Points come in identical pairs (0 and 1, 2 and 3, ...), and every fourth point is a near-empty placeholder.
+        i, size = _query(path)
+        if i % 4 == 3:
+            return b"grey"
+        return "{0} {1} ".format(size, i // 2).encode("utf-8") * 200
+
+    fake_streetview.image_body = image_body
+    look_points = [(45.0 + i * 1e-4, -73.0) for i in range(20)]
+    keepers = utils.download_images_for_path_laddered("KEY", "t", look_points, picsize="640x640", thumbsize="160x160",
+                                                      threads=4)
+    assert keepers == list(range(0, 20, 2))
+    assert sorted(os.listdir("photos/thumbs")) == sorted("t_{0}.jpg".format(i) for i in range(20))
+    full_size = [_query(path)[0] for path in fake_streetview.paths
+                 if "/metadata" not in path and _query(path)[1] == "640x640"]
+    assert sorted(set(full_size)) == keepers
+    assert sorted(name for name in os.listdir("photos") if name.endswith(".jpg")) == \
+        sorted("t_{0}.jpg".format(i) for i in keepers)
+
+
+def test_thumbsize_implies_ladder(monkeypatch):
+    calls = []
+    monkeypatch.setattr(street_crawl, "download", lambda filestem, picsize, **kwargs: calls.append(kwargs["thumbsize"]))
+    street_crawl.run(["download", "stem", "--yes"])
+    street_crawl.run(["download", "stem", "--yes", "--ladder"])
+    street_crawl.run(["download", "stem", "--yes", "--thumbsize", "320x320"])
+    assert calls == [None, street_crawl.DEFAULT_THUMBNAIL_PICSIZE, "320x320"]
@@ -0,0 +1,52 @@
+import math
+
+import numpy as np
+
+from utils import resample_path, path_headings, haversine
+
+EARTH_RADIUS = 6367000.0
+
+
+def offset(north, east, lat0=45.0, lon0=-73.0):
+    # A point the given number of meters north and east of (lat0, lon0).
+    return (lat0 + math.degrees(north / EARTH_RADIUS),
+            lon0 + math.degrees(east / (EARTH_RADIUS * math.cos(math.radians(lat0)))))
+
+
+def max_heading_step(look_points):
+    headings = path_headings(look_points)
+    return np.max(np.abs((np.diff(headings) + 180) % 360 - 180))
+
+
+def test_sharp_corner_turns_gradually():
+    look_points = resample_path([offset(0, 0), offset(0, 1000), offset(1000, 1000)], max_turn=15)
+    assert max_heading_step(look_points) <= 15
+    assert look_points[0] == offset(0, 0)
+    assert np.allclose(look_points[-1], offset(1000, 1000))
+
+
+def test_straight_road_uses_frame_budget():
+    look_points = resample_path([offset(0, 0), offset(0, 5000)], frames_per_km=20)
+    spacings = [haversine(a, b) for a, b in zip(look_points[:-1], look_points[1:])]
+    assert abs(len(look_points) - 101) <= 1
+    assert max(spacings) <= 50.1
+
+
+def test_route_shorter_than_min_spacing():
+    assert len(resample_path([offset(0, 0), offset(0, 0.3)], min_spacing=1)) == 2
+
+
+def test_short_jog_between_sharp_corners():
+    # Two right angles 30 m apart, closer than twice turn_window.
+    look_points = resample_path([offset(0, 0), offset(0, 300), offset(30, 300), offset(30, 600)])
+    assert max_heading_step(look_points) <= 15
+    assert np.allclose(look_points[-1], offset(30, 600))
+
+
+def test_tight_bend_sampled_every_20_degrees():
+    # A 30 m radius half-circle, as a polyline with a vertex every 20 degrees, with straight approaches.
+    bend = [offset(30 - 30 * math.cos(math.radians(a)), 300 + 30 * math.sin(math.radians(a)))
+            for a in range(0, 181, 20)]
+    look_points = resample_path([offset(0, 0)] + bend + [offset(60, 0)])
+    assert max_heading_step(look_points) <= 15
+    assert np.allclose(look_points[-1], offset(60, 0))
@@ -0,0 +1,82 @@
+import json
+import multiprocessing
+import os
+import time
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+import throttle
+import utils
+
+
+def test_download_recovers_from_throttling(fake_streetview):
+    budget = throttle.DailyBudget("budget.json", 1000)
+    utils.set_throttle(throttle.AdaptiveThrottle(budget=budget, base_delay=0.01, max_delay=0.1))
+    look_points = [(45.0 + i * 1e-4, -73.0) for i in range(60)]
+    responses = utils.download_images_for_path("KEY", "t", look_points, picsize="640x640", threads=12)
+    assert all(response["status"] == "OK" for response in responses)
+    files = os.listdir("photos")
+    assert len([name for name in files if name.endswith(".jpg")]) == 60
+    assert not [name for name in files if name.endswith(".part")]
+    assert fake_streetview.counts["throttled"] > 0
+    assert utils.get_throttle().stats["retries"] == fake_streetview.counts["throttled"]
+    # Only image requests that got through are billed: not the ones rejected with 429, and not free metadata requests.
+    assert budget.used == json.load(open("budget.json"))["used"] == 60
+
+
+def test_download_stops_at_budget(fake_streetview):
+    utils.set_throttle(throttle.AdaptiveThrottle(budget=throttle.DailyBudget("budget.json", 5), base_delay=0.01))
+    with pytest.raises(throttle.BudgetExceededError):
+        utils.download_images_for_path("KEY", "t", [(45.0 + i * 1e-4, -73.0) for i in range(10)], picsize="640x640")
+    assert len([name for name in os.listdir("photos") if name.endswith(".jpg")]) <= 5
+
+
+def _spend_until_exceeded(path, limit, spent):
+    budget = throttle.DailyBudget(path, limit)
+    while True:
+        try:
+            budget.spend()
+        except throttle.BudgetExceededError:
+            return
+        with spent.get_lock():
+            spent.value += 1
+
+
+def test_budget_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "budget.json")
+    spent = multiprocessing.Value("i", 0)
+    processes = [multiprocessing.Process(target=_spend_until_exceeded, args=(path, 50, spent)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert spent.value == 50
+    assert json.load(open(path))["used"] == 50
+    assert throttle.DailyBudget(path, 50).remaining() == 0
+
+
+def test_failed_attempts_are_billed_only_if_they_reached_google(tmp_path):
+    budget = throttle.DailyBudget(str(tmp_path / "budget.json"), 100)
+    errors = [HTTPError("url", 429, "Too Many Requests", {}, None), URLError("connection refused"),
+              HTTPError("url", 503, "Service Unavailable", {}, None)]
+
+    def request():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert throttle.AdaptiveThrottle(budget=budget, base_delay=0.001).call(request) == "ok"
+    # The 503 and the final success were served; the 429 and the refused connection were not.
+    assert budget.remaining() == 98
+
+
+def test_threads_share_one_default_throttle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, "AdaptiveThrottle", lambda **kwargs: (time.sleep(0.01), object())[1])
+    utils.set_throttle(None)
+    try:
+        throttles = utils.map_points(lambda i: utils.get_throttle(), range(16), threads=16)
+    finally:
+        utils.set_throttle(None)
+    assert len(set(map(id, throttles))) == 1
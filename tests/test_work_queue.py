@@ -0,0 +1,91 @@
+import os
+import time
+
+from work_queue import WorkQueue, run_worker, run_workers
+
+N_POINTS = 203
+
+
+def _marker_dir(db_path):
+    return os.path.join(os.path.dirname(db_path), "done")
+
+
+def _make_stub(db_path, delay=0.0):
+    # Records which process handled each point, one file per (point, process).
+    marker_dir = _marker_dir(db_path)
+
+    def process_shard(start, stop):
+        time.sleep(delay)
+        for i in range(start, stop):
+            open(os.path.join(marker_dir, "{0}_{1}".format(i, os.getpid())), "w").close()
+
+    return process_shard
+
+
+def _handled(db_path):
+    handled = {}
+    for name in os.listdir(_marker_dir(db_path)):
+        point, pid = name.split("_")
+        handled.setdefault(int(point), set()).add(pid)
+    return handled
+
+
+def _setup(tmp_path, shard_size):
+    db_path = str(tmp_path / "queue.sqlite")
+    os.makedirs(_marker_dir(db_path))
+    queue = WorkQueue(db_path)
+    queue.enqueue(N_POINTS, shard_size, settings={"filestem": "test", "picsize": "640x640"})
+    return db_path, queue
+
+
+def test_workers_cover_every_point_and_reclaim_dead_lease(tmp_path):
+    db_path, queue = _setup(tmp_path, shard_size=10)
+    # A worker that claims the first shard and then dies without finishing it.
+    dead_shard = queue.claim("dead-worker", lease_seconds=0.5)
+    assert dead_shard[1:] == (0, 10)
+
+    progress = run_workers(db_path, 4, _make_stub(db_path), lease_seconds=5, poll_seconds=0.1)
+
+    assert progress == {"pending": 0, "leased": 0, "done": 21, "failed": 0}
+    handled = _handled(db_path)
+    assert sorted(handled) == list(range(N_POINTS))
+    assert len(set.union(*handled.values())) > 1
+    # The dead worker's lease was taken over, so its late completion must be refused.
+    assert not queue.complete(dead_shard[0], "dead-worker")
+    assert not queue.renew(dead_shard[0], "dead-worker")
+
+
+def test_lease_is_renewed_while_shard_is_slow(tmp_path):
+    db_path, queue = _setup(tmp_path, shard_size=N_POINTS)
+    # Each step takes longer than the lease, so without renewal a second worker would steal the shard.
+    progress = run_workers(db_path, 2, _make_stub(db_path, delay=0.4), lease_seconds=0.3, poll_seconds=0.05,
+                           step=50)
+
+    assert progress["done"] == 1
+    assert all(len(pids) == 1 for pids in _handled(db_path).values())
+
+
+def test_worker_abandons_shard_after_losing_lease(tmp_path):
+    db_path, queue = _setup(tmp_path, shard_size=N_POINTS)
+    calls = []
+
+    def process_shard(start, stop):
+        calls.append(start)
+        # Simulate another worker taking over the shard mid-way and finishing it.
+        with queue._connect() as conn:
+            conn.execute("UPDATE shards SET owner = 'someone-else', status = 'done'")
+        time.sleep(0.2)
+
+    assert run_worker(db_path, process_shard, worker_id="me", lease_seconds=0.3, poll_seconds=0.05, step=50) == 0
+    assert len(calls) < 5
+
+
+def test_shard_whose_workers_keep_dying_is_failed(tmp_path):
+    db_path, queue = _setup(tmp_path, shard_size=100)
+    for attempt in range(3):
+        shard = queue.claim("crashing-worker-{0}".format(attempt), lease_seconds=0.01, max_attempts=3)
+        assert shard[0] == 1
+        time.sleep(0.05)
+    # The first shard has used up its attempts, so the next claim gets the second shard instead.
+    assert queue.claim("healthy-worker", max_attempts=3)[0] == 2
+    assert queue.progress() == {"pending": 1, "leased": 1, "done": 0, "failed": 1}
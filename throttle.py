@@ -0,0 +1,207 @@
+import datetime
+import fcntl
+import json
+import os
+import random
+import socket
+import threading
+import time
+from urllib.error import HTTPError, URLError
+
+'''Retry, backoff and adaptive concurrency for calls to the Google APIs.
+
+Every Street View request goes through AdaptiveThrottle.call, which
+- limits how many requests are in flight at once, raising the limit slowly while requests succeed and halving it as soon
+  as the API pushes back (AIMD, as in TCP congestion control), so throughput settles just under the provider's limit;
+- retries throttled and transient failures (HTTP 429 and 5xx, OVER_QUERY_LIMIT, network errors) after a randomized,
+  exponentially growing wait, or the server's Retry-After if it sent one;
+- counts billable requests against a daily budget saved to disk, and stops before going over it.
+
+The API base URL can be pointed elsewhere (see config.STREETVIEW_BASE_URL), e.g. at a local fake server that injects
+throttling, to try the controller out without spending quota.
+'''
+
+RETRYABLE_HTTP_CODES = [429, 500, 502, 503, 504]
+# Metadata statuses that mean "try again later" rather than "no imagery here".
+RETRYABLE_STATUSES = ["OVER_QUERY_LIMIT", "UNKNOWN_ERROR"]
+
+
+class ThrottledError(Exception):
+    """
+    The API asked us to slow down, or failed in a way that is worth retrying.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super(ThrottledError, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class DailyBudget(object):
+    """
+    Number of billable requests made today, saved in a small JSON file so that it carries over between runs.\n
+    The file is the count: every spend re-reads it under an exclusive file lock, so worker processes on the same
+    host (e.g. "work --processes 4") share one budget.
+    """
+
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.date, self.used = self._load()
+
+    @staticmethod
+    def _today():
+        return datetime.date.today().isoformat()
+
+    def _load(self):
+        today = self._today()
+        if os.path.isfile(self.path):
+            with open(self.path) as reader:
+                saved = json.load(reader)
+            if saved["date"] == today:
+                return today, saved["used"]
+        return today, 0
+
+    def spend(self, n=1):
+        self._add(n)
+
+    def refund(self, n=1):
+        # Give back requests that were reserved with spend but turned out not to be billed.
+        self._add(-n)
+
+    def _add(self, n):
+        # The threading lock keeps threads of this process in line; flock keeps the other processes out.
+        with self.lock, open(self.path + ".lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.date, self.used = self._load()
+                if n > 0 and self.limit is not None and self.used + n > self.limit:
+                    raise BudgetExceededError("Daily budget of {0} requests used up".format(self.limit))
+                self.used = max(0, self.used + n)
+                tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+                with open(tmp_path, 'w') as writer:
+                    json.dump({"date": self.date, "used": self.used}, writer)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def remaining(self):
+        if self.limit is None:
+            return None
+        self.date, self.used = self._load()
+        return self.limit - self.used
+
+
+class AdaptiveThrottle(object):
+    def __init__(self, budget=None, initial_concurrency=2, min_concurrency=1, max_concurrency=16, increase=1.0,
+                 decrease_factor=0.5, max_retries=6, base_delay=0.5, max_delay=60):
+        self.budget = budget
+        self.limit = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.last_decrease = 0
+        self.stats = {"ok": 0, "throttled": 0, "retries": 0}
+
+    def _acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return time.time()
+
+    def _release(self, started, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.stats["throttled"] += 1
+                # Requests already in flight when we were throttled will likely be throttled too;
+                # only cut the limit once for them.
+                if started > self.last_decrease:
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                    self.last_decrease = time.time()
+            else:
+                self.stats["ok"] += 1
+                # About +increase per limit's worth of successes, i.e. per round trip at full concurrency.
+                self.limit = min(self.max_concurrency, self.limit + self.increase / self.limit)
+            self.condition.notify_all()
+
+    def backoff(self, attempt, retry_after=None):
+        # "Full jitter": a uniformly random wait up to the exponential cap, so that clients don't retry in lockstep.
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, function, *args, billable=True, **kwargs):
+        """
+        Call function(*args, **kwargs), retrying throttled and transient failures.\n
+        function should raise ThrottledError (or let HTTPError/URLError through) when the request should be retried.
+        Billable calls are counted against the daily budget, retries included, except attempts that Google doesn't
+        bill: those rejected with HTTP 429 and those that never connected. Each attempt reserves its request before it
+        is sent, so that concurrent requests can't overshoot the budget, and gives it back if it wasn't billed.
+        """
+        for attempt in range(self.max_retries + 1):
+            charged = billable and self.budget is not None
+            if charged:
+                self.budget.spend()
+            started = self._acquire()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if charged and not was_billed(e):
+                    self.budget.refund()
+                error = as_throttled_error(e)
+                self._release(started, throttled=error is not None)
+                if error is None:
+                    raise
+                if attempt == self.max_retries:
+                    raise error
+                delay = self.backoff(attempt, error.retry_after)
+                print("Request throttled or failed ({0}); retrying in {1:.1f}s".format(error, delay))
+                with self.condition:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+            else:
+                self._release(started, throttled=False)
+                return result
+
+
+def as_throttled_error(error):
+    """
+    The ThrottledError equivalent of error if it's worth retrying, otherwise None.
+    """
+    if isinstance(error, ThrottledError):
+        return error
+    if isinstance(error, HTTPError):
+        if error.code not in RETRYABLE_HTTP_CODES:
+            return None
+        retry_after = error.headers.get("Retry-After") if error.headers is not None else None
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return ThrottledError("HTTP {0}".format(error.code), retry_after)
+    if isinstance(error, (URLError, socket.timeout, ConnectionError)):
+        return ThrottledError(str(error))
+    return None
+
+
+def was_billed(error):
+    """
+    Whether a request that failed with error may still have been billed: False if the API rejected it as throttled
+    (HTTP 429), or if we never got through to the API (a URLError other than an HTTP error, e.g. connection refused).
+    A timeout or a dropped connection may have happened after the request was served, so those count.
+    """
+    if isinstance(error, HTTPError):
+        return error.code != 429
+    return not isinstance(error, URLError)
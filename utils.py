@@ -5,12 +5,19 @@ import json
 import math
 import os
 import subprocess
-from urllib.request import urlopen, urlretrieve
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
 
 import numpy as np
-import pandas as pd
 
-from street_crawl import DEFAULT_STREETVIEW_PHOTO_FOLDER, DEFAULT_PHOTO_EXTENSION, DEFAULT_VIDEO_OUTPUT_FOLDER
+from config import DEFAULT_STREETVIEW_PHOTO_FOLDER, DEFAULT_PHOTO_EXTENSION, DEFAULT_VIDEO_OUTPUT_FOLDER, \
+    DEFAULT_THUMBNAIL_FOLDER, DEFAULT_THUMBNAIL_PICSIZE, STREETVIEW_BASE_URL, DEFAULT_DAILY_BUDGET, DEFAULT_BUDGET_FILE, \
+    DEFAULT_REQUEST_TIMEOUT
+from throttle import AdaptiveThrottle, DailyBudget, ThrottledError, RETRYABLE_STATUSES
+
+# pandas is only needed by the itinerary helpers, so it is imported inside them
+# rather than here; importing utils for line-up or rendering stays cheap.
 
 
 # Some useful Google API documentation:
@@ -18,6 +25,49 @@ from street_crawl import DEFAULT_STREETVIEW_PHOTO_FOLDER, DEFAULT_PHOTO_EXTENSIO
 # https://developers.google.com/maps/documentation/roads/snap
 
 
+_throttle = None
+# Held while creating _throttle: the first calls come from map_points' threads, and they must all share one throttle.
+_throttle_lock = threading.Lock()
+
+
+def get_throttle():
+    """
+    The AdaptiveThrottle shared by all Street View requests in this process, created on first use.
+    """
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = AdaptiveThrottle(budget=DailyBudget(DEFAULT_BUDGET_FILE, DEFAULT_DAILY_BUDGET))
+        return _throttle
+
+
+def set_throttle(throttle):
+    # E.g. to change the budget or concurrency limits, or to pass None to go back to the default.
+    global _throttle
+    with _throttle_lock:
+        _throttle = throttle
+
+
+def _fetch_to_file(url, file_path):
+    # Write to a temporary file first, so that a failed request never leaves an empty or partial image behind.
+    # The name is unique per process and thread, in case two workers ever fetch the same image.
+    tmp_path = "{0}.{1}.{2}.part".format(file_path, os.getpid(), threading.get_ident())
+    with urlopen(url, timeout=DEFAULT_REQUEST_TIMEOUT) as response:
+        data = response.read()
+    with open(tmp_path, 'wb') as writer:
+        writer.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def _fetch_metadata(url):
+    with urlopen(url, timeout=DEFAULT_REQUEST_TIMEOUT) as response:
+        json_response = response.read().decode("utf-8")
+    status = json.loads(json_response).get('status')
+    if status in RETRYABLE_STATUSES:
+        raise ThrottledError(status)
+    return json_response
+
+
 # Adapted directly from Andrew Wheeler:
 # https://andrewpwheeler.wordpress.com/2015/12/28/using-python-to-grab-google-street-view-imagery/
 # Usage example:
@@ -25,24 +75,32 @@ from street_crawl import DEFAULT_STREETVIEW_PHOTO_FOLDER, DEFAULT_PHOTO_EXTENSIO
 def download_streetview_image(apikey_streetview, lat_lon, file_path=".", picsize="600x300",
                               heading=151.78, pitch=-0, fov=90, outdoor=True, radius=5):
     url = prepare_url(apikey_streetview, lat_lon, picsize, heading, pitch, fov, False, outdoor, radius)
-    print("Retrieving image from: " + url)
     if not os.path.isfile(file_path):
-        urlretrieve(url, file_path)
+        print("Retrieving image from: " + url)
+        get_throttle().call(_fetch_to_file, url, file_path)
     return file_path
 
 
 def download_streetview_image_metadata(apikey_streetview, lat_lon, file_path, picsize="600x300", heading=151.78, pitch=-0, fov=90, outdoor=True,
                                        radius=5):
     """
-    Description of metadata API: https://developers.google.com/maps/documentation/streetview/intro#size
+    Description of metadata API: https://developers.google.com/maps/documentation/streetview/intro#size\n
+    Metadata requests are free, so they don't count against the daily budget, but they are throttled and retried.
     """
     url = prepare_url(apikey_streetview, lat_lon, picsize, heading, pitch, fov, True, outdoor, radius)
     print("Retrieving metadata from: " + url)
-    with urlopen(url) as response:
-        json_response = response.read().decode("utf-8")
-        with open(file_path, 'w') as writer:
-            writer.write(json_response)
-        return json.loads(json_response)
+    json_response = get_throttle().call(_fetch_metadata, url, billable=False)
+    with open(file_path, 'w') as writer:
+        writer.write(json_response)
+    return json.loads(json_response)
+
+
+def photo_path(filestem, i, thumbnail=False):
+    """
+    Where image i of a filestem lives. Thumbnails and full-resolution images share the same name in different folders.
+    """
+    folder = DEFAULT_THUMBNAIL_FOLDER if thumbnail else DEFAULT_STREETVIEW_PHOTO_FOLDER
+    return folder + "{0}_{1}".format(filestem, i) + DEFAULT_PHOTO_EXTENSION
 
 
 def prepare_url(apikey_streetview, lat_lon, picsize="600x300", heading=151.78, pitch=-0, fov=90, get_metadata=False, outdoor=True, radius=5):
@@ -51,7 +109,7 @@ def prepare_url(apikey_streetview, lat_lon, picsize="600x300", heading=151.78, p
     fov is the zoom level, effectively. Between 0 and 120.
     """
     assert type(radius) is int
-    base = "https://maps.googleapis.com/maps/api/streetview"
+    base = STREETVIEW_BASE_URL
     if get_metadata:
         base = base + "/metadata?parameters"
     if type(lat_lon) is tuple:
@@ -128,30 +186,213 @@ def clean_look_points(look_points):
     return look_points_out
 
 
-def download_images_for_path(apikey_streetview, filestem, look_points, orientation=1, picsize="640x320"):
+def round_corners(pts, max_turn=15, turn_window=20):
     """
-    Download street view images for a sequence of GPS points.\n
+    Replace each polyline vertex that turns by more than max_turn degrees with a curve (a quadratic Bezier) that starts
+    and ends up to turn_window meters either side of it, made of pieces that each turn by at most max_turn / 2.\n
+    Points sampled along a sharp vertex all share the bearing of one side or the other; along the curve, they turn gradually.
+    U-turns (close to 180 degrees) can't be rounded this way and still turn all at once.
+    """
+    out = [pts[0]]
+    for i in range(1, len(pts) - 1):
+        # Local flat coordinates in meters around the vertex.
+        scale = np.array([1.0, np.cos(np.radians(pts[i][0]))]) * np.radians(1) * 6367000.0
+        d_in, d_out = (pts[i] - pts[i - 1]) * scale, (pts[i + 1] - pts[i]) * scale
+        len_in, len_out = np.hypot(*d_in), np.hypot(*d_out)
+        cos_turn = np.dot(d_in, d_out) / (len_in * len_out)
+        turn = np.degrees(np.arccos(np.clip(cos_turn, -1, 1)))
+        if turn <= max_turn:
+            out += [pts[i]]
+            continue
+        # Use at most 40% of either segment, so that neighbouring curves neither overlap nor touch
+        # (touching curves would leave a zero-length segment between them, which has no heading).
+        cut = min(turn_window, 0.4 * len_in, 0.4 * len_out)
+        start, end = pts[i] - d_in / len_in * cut / scale, pts[i] + d_out / len_out * cut / scale
+        t = np.linspace(0, 1, int(np.ceil(2 * turn / max_turn)) + 1)[:, None]
+        out += list((1 - t) ** 2 * start + 2 * (1 - t) * t * pts[i] + t ** 2 * end)
+    out += [pts[-1]]
+    return np.array(out)
+
+
+def _segments(pts):
+    # Length in meters and compass bearing of each segment of an array of lat/lon points.
+    # Vectorized versions of haversine and calculate_initial_compass_bearing.
+    lat, lon = np.radians(pts[:, 0]), np.radians(pts[:, 1])
+    dlat, dlon = np.diff(lat), np.diff(lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+    seg_lengths = 2 * 6367000.0 * np.arcsin(np.sqrt(np.minimum(a, 1)))
+    bearings = np.degrees(np.arctan2(np.sin(dlon) * np.cos(lat[1:]),
+                                     np.cos(lat[:-1]) * np.sin(lat[1:]) - np.sin(lat[:-1]) * np.cos(lat[1:]) * np.cos(dlon)))
+    return seg_lengths, bearings
+
+
+def resample_path(path_points, frames_per_km=60, max_turn=15, turn_window=20, max_spacing=50, min_spacing=1):
+    """
+    Resample a decoded polyline by geodesic arc length, instead of interpolating each segment separately.\n
+    Sharp corners are first rounded off within turn_window meters (see round_corners).
+    The route gets frames_per_km * length frames in total. Turns get enough of them that the heading changes by at most
+    about max_turn degrees per frame, and the rest are spread evenly over the straight parts, never more than max_spacing
+    meters apart. Points closer than min_spacing meters are dropped (except the two ends of the route),
+    so no cleaning pass is needed afterwards.
+    """
+    pts = np.asarray(path_points, dtype=float)
+    # Drop repeated vertices: they have no length and no heading.
+    pts = pts[np.concatenate([[True], np.any(np.diff(pts, axis=0) != 0, axis=1)])]
+    if len(pts) < 2:
+        return [tuple(pt) for pt in pts.tolist()]
+    pts = round_corners(pts, max_turn, turn_window)
+    seg_lengths, bearings = _segments(pts)
+    if np.any(seg_lengths < 1e-3):
+        # Rounding can leave (nearly) repeated points behind; drop them too.
+        pts = pts[np.concatenate([[True], seg_lengths >= 1e-3])]
+        seg_lengths, bearings = _segments(pts)
+    arc = np.concatenate([[0], np.cumsum(seg_lengths)])
+    total_length = arc[-1]
+    # Turn at each interior vertex, in degrees, and the frames needed to take it at max_turn per frame.
+    turns = np.abs((np.diff(bearings) + 180) % 360 - 180)
+    turn_frames = turns / max_turn
+    half_widths = np.minimum(turn_window, 0.5 * np.minimum(seg_lengths[:-1], seg_lengths[1:]))
+    # Whatever the turns don't use of the budget goes to the straight parts.
+    budget = frames_per_km * total_length / 1000.0
+    base_density = max((budget - turn_frames.sum()) / total_length, 1.0 / max_spacing)
+    # Piecewise-constant frame density along the arc: the base density, plus a box around each bend.
+    # Integrate it at every breakpoint to get the cumulative frame count.
+    centres = arc[1:-1]
+    box_density = np.where(half_widths > 0, turn_frames / (2 * np.maximum(half_widths, 1e-9)), 0)
+    events = np.concatenate([[0, total_length], centres - half_widths, centres + half_widths])
+    steps = np.concatenate([[base_density, -base_density], box_density, -box_density])
+    order = np.argsort(events, kind="stable")
+    events, density = events[order], np.cumsum(steps[order])
+    cumulative_frames = np.concatenate([[0], np.cumsum(density[:-1] * np.diff(events))])
+    # One frame at each whole number of cumulative frames, mapped back to arc length and then to lat/lon.
+    n_frames = int(np.floor(cumulative_frames[-1]))
+    samples = np.interp(np.arange(n_frames + 1), cumulative_frames, events)
+    samples = samples[samples < total_length - min_spacing]
+    if len(samples) == 0:
+        # A route shorter than min_spacing: just its two ends.
+        samples = np.array([0.0])
+    samples = np.append(samples[np.concatenate([[True], np.diff(samples) >= min_spacing])], total_length)
+    return list(zip(np.interp(samples, arc, pts[:, 0]).tolist(), np.interp(samples, arc, pts[:, 1]).tolist()))
+
+
+def path_headings(look_points, orientation=1):
+    """
+    Heading for each of a sequence of GPS points.\n
     The orientation is assumed to be towards the next point.\n
     Setting orientation to value N orients the camera to the Nth next point.\n
     If there isn't a point N points in the future, we just use the previous heading.
     """
     assert type(orientation) is int
     assert orientation >= 1
+    headings = []
     for i in range(len(look_points)):
-        gps_point = look_points[i]
         if i + orientation >= len(look_points):
-            heading = prev_heading
+            heading = headings[-1] if headings else 0
         else:
-            heading = calculate_initial_compass_bearing(gps_point, look_points[i + orientation])
-        file_path_no_extension = DEFAULT_STREETVIEW_PHOTO_FOLDER + filestem + "_" + str(i)
-        # Don't query if file already exists.
-        if not os.path.isfile(file_path_no_extension + ".json"):
-            response = download_streetview_image_metadata(apikey_streetview, gps_point, file_path_no_extension + ".json", heading=heading,
-                                                          picsize=picsize)
-            if response['status'] == "OK" and 'Google' in response['copyright']:
-                download_streetview_image(apikey_streetview, gps_point, file_path_no_extension + DEFAULT_PHOTO_EXTENSION, heading=heading,
-                                          picsize=picsize)
-        prev_heading = heading
+            heading = calculate_initial_compass_bearing(tuple(look_points[i]), tuple(look_points[i + orientation]))
+        headings += [heading]
+    return headings
+
+
+def probe_point(apikey_streetview, filestem, i, lat_lon, heading, picsize="640x320"):
+    """
+    Metadata for look point i, from the .json file saved next to where its image would go, or downloaded if there isn't one.
+    """
+    file_path_no_extension = DEFAULT_STREETVIEW_PHOTO_FOLDER + filestem + "_" + str(i)
+    # Don't query if file already exists.
+    if os.path.isfile(file_path_no_extension + ".json"):
+        with open(file_path_no_extension + ".json") as reader:
+            return json.load(reader)
+    return download_streetview_image_metadata(apikey_streetview, tuple(lat_lon), file_path_no_extension + ".json",
+                                              heading=heading, picsize=picsize)
+
+
+def map_points(function, indices, threads=1):
+    # Apply function to each index, in order, with up to `threads` requests at a time.
+    # The shared throttle decides how many of those are actually in flight.
+    if threads <= 1:
+        return [function(i) for i in indices]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(function, indices))
+
+
+def probe_images_for_path(apikey_streetview, filestem, look_points, orientation=1, picsize="640x320", indices=None,
+                          threads=1):
+    """
+    Download only the metadata for a sequence of GPS points, saved next to where each image would go.\n
+    Returns the metadata responses, in order; points left out of indices get None.
+    """
+    headings = path_headings(look_points, orientation)
+    if indices is None:
+        indices = range(len(look_points))
+    responses = [None] * len(look_points)
+
+    def probe(i):
+        return probe_point(apikey_streetview, filestem, i, look_points[i], headings[i], picsize)
+
+    for i, response in zip(indices, map_points(probe, indices, threads)):
+        responses[i] = response
+    return responses
+
+
+def download_images_for_path(apikey_streetview, filestem, look_points, orientation=1, picsize="640x320", indices=None,
+                             thumbnail=False, threads=1):
+    """
+    Download street view images for a sequence of GPS points.\n
+    Points are probed first (reusing any metadata already on disk), and only points with Google imagery are downloaded.\n
+    Set indices to only download some of the points, and thumbnail to save them to the thumbnail folder.\n
+    See path_headings for the meaning of orientation.
+    """
+    headings = path_headings(look_points, orientation)
+    if indices is None:
+        indices = range(len(look_points))
+    if thumbnail and not os.path.exists(DEFAULT_THUMBNAIL_FOLDER):
+        os.makedirs(DEFAULT_THUMBNAIL_FOLDER)
+    responses = [None] * len(look_points)
+
+    def fetch(i):
+        response = probe_point(apikey_streetview, filestem, i, look_points[i], headings[i], picsize)
+        if response['status'] == "OK" and 'Google' in response['copyright']:
+            download_streetview_image(apikey_streetview, tuple(look_points[i]), photo_path(filestem, i, thumbnail),
+                                      heading=headings[i], picsize=picsize)
+        return response
+
+    for i, response in zip(indices, map_points(fetch, indices, threads)):
+        responses[i] = response
+    return responses
+
+
+def select_frames_from_thumbnails(filestem, responses, min_bytes=1000):
+    """
+    Pick the points worth fetching at full resolution, judging by their thumbnails:\n
+    drop points without Google imagery, near-empty images (smaller than min_bytes, e.g. flat grey placeholders),
+    and images identical to the previous keeper.
+    """
+    candidates = [i for i in range(len(responses))
+                  if responses[i] is not None and responses[i]['status'] == "OK" and 'Google' in responses[i]['copyright']
+                  and os.path.isfile(photo_path(filestem, i, thumbnail=True))
+                  and os.path.getsize(photo_path(filestem, i, thumbnail=True)) >= min_bytes]
+    if not candidates:
+        return []
+    keepers = prune_repeated_images_from_list([photo_path(filestem, i, thumbnail=True) for i in candidates])
+    keeper_paths = set(keepers)
+    return [i for i in candidates if photo_path(filestem, i, thumbnail=True) in keeper_paths]
+
+
+def download_images_for_path_laddered(apikey_streetview, filestem, look_points, orientation=1, picsize="640x640",
+                                      thumbsize=DEFAULT_THUMBNAIL_PICSIZE, min_bytes=1000, threads=1):
+    """
+    Two-tier version of download_images_for_path:
+    fetch thumbnails for every point with imagery, then full resolution only for the frames that survive
+    select_frames_from_thumbnails. Returns the indices of those frames.
+    """
+    responses = download_images_for_path(apikey_streetview, filestem, look_points, orientation, picsize=thumbsize,
+                                         thumbnail=True, threads=threads)
+    keepers = select_frames_from_thumbnails(filestem, responses, min_bytes=min_bytes)
+    print("{0} of {1} points survived thumbnail screening.".format(len(keepers), len(look_points)))
+    download_images_for_path(apikey_streetview, filestem, look_points, orientation, picsize=picsize, indices=keepers,
+                             threads=threads)
+    return keepers
 
 
 def get_turn_headings(h1, h2, stepsize=15):
@@ -196,14 +437,16 @@ def get_turn_headings(h1, h2, stepsize=15):
 # 	return pt_list
 
 def create_itinerary_df(gps_points):
+    import pandas as pd
     # Create dataframe with GPS points
     pt_list = pd.DataFrame(index=range(len(gps_points)),
                            columns=["lat", "lon", "heading", "probe", "copyright", "date", "location", "pano_id",
-                                    "status", "downloaded_1", "downloaded_array"])
+                                    "status", "downloaded_1", "downloaded_thumb", "downloaded_array"])
     lats, lons = zip(*gps_points)
     pt_list['lat'] = lats
     pt_list['lon'] = lons
     pt_list['downloaded_1'] = False
+    pt_list['downloaded_thumb'] = False
     pt_list['downloaded_array'] = False
     # Compute basic headings
     headings = [calculate_initial_compass_bearing(pt[0], pt[1]) for pt in zip(gps_points[:-1], gps_points[1:])]
@@ -232,6 +475,7 @@ def probe_itinerary_items(itinerary_df, indlist, apikey_streetview, redo=False):
 
 
 def process_pointlist(pt_list=None, pt_list_filename=None):
+    import pandas as pd
     if pt_list is None and pt_list_filename is not None:
         pt_list = pd.read_pickle(pt_list_filename)
     # Remove duplicate / invalid points:
@@ -259,16 +503,27 @@ def process_pointlist(pt_list=None, pt_list_filename=None):
     return final_list
 
 
-def download_pics_from_list(item_list, apikey_streetview, filestem, picsize, redownload=False, index_filter=None):
+def download_pics_from_list(item_list, apikey_streetview, filestem, picsize, redownload=False, index_filter=None,
+                            thumbnail=False):
+    """
+    Download the images for an itinerary dataframe.\n
+    With thumbnail=True, images go to the thumbnail folder and are tracked in the "downloaded_thumb" column,
+    so a cheap pass can be made over the whole itinerary before fetching full resolution for the chosen rows.
+    """
     if index_filter is None:
         index_filter = item_list.index
+    downloaded_column = "downloaded_thumb" if thumbnail else "downloaded_1"
+    if downloaded_column not in item_list.columns:
+        item_list[downloaded_column] = False
+    if thumbnail and not os.path.exists(DEFAULT_THUMBNAIL_FOLDER):
+        os.makedirs(DEFAULT_THUMBNAIL_FOLDER)
     for i in index_filter:
-        file_path = DEFAULT_STREETVIEW_PHOTO_FOLDER + "{0}_{1}".format(filestem, i) + DEFAULT_PHOTO_EXTENSION
+        file_path = photo_path(filestem, i, thumbnail)
         row = item_list.loc[i]
-        lat, lon, heading, downloaded = row['lat'], row['lon'], row['heading'], row['downloaded_1']
+        lat, lon, heading, downloaded = row['lat'], row['lon'], row['heading'], row[downloaded_column]
         if (not downloaded) or redownload:
             download_streetview_image(apikey_streetview, (lat, lon), file_path, heading=heading, picsize=picsize)
-            item_list["downloaded_1"].loc[i] = True
+            item_list.loc[i, downloaded_column] = True
 
 
 # def download_tableaux_from_list(item_list, apikey_streetview, filestem, picsize, fov, fov_step, pitch, grid_dim, index_filter=None):
@@ -328,6 +583,13 @@ def extract_photo_number(path):
     return segments[len(segments) - 1]
 
 
+def sorted_photos(filestem):
+    # Downloaded images for a filestem, in route order.
+    files = glob.glob(DEFAULT_STREETVIEW_PHOTO_FOLDER + filestem + "*" + DEFAULT_PHOTO_EXTENSION)
+    file_nums = [int(extract_photo_number(path)) for path in files]
+    return [files[i] for i in np.argsort(file_nums)]
+
+
 # Line up files in order to make a video using ffmpeg.
 # ffmpeg requires all images files numbered in sequence, with no gaps.
 # However, some images will not have been downloaded, so we need to shift everything to tidy up gaps.
@@ -336,9 +598,7 @@ def extract_photo_number(path):
 def line_up_files(filestem, new_dir="./movie_lineup", command="mv", override_nums=None):
     if not os.path.exists(new_dir):
         os.makedirs(new_dir)
-    files = glob.glob(DEFAULT_STREETVIEW_PHOTO_FOLDER + filestem + "*" + DEFAULT_PHOTO_EXTENSION)
-    file_nums = [int(extract_photo_number(path)) for path in files]
-    file_sort = [files[i] for i in np.argsort(file_nums)]
+    file_sort = sorted_photos(filestem)
     # First, remove file_nums that represent duplicate files
     file_keepers = prune_repeated_images_from_list(file_sort)
     # for i in range(1,len(file_sort)):
@@ -0,0 +1,240 @@
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from config import DEFAULT_THREADS
+
+'''Lease-based work queue for sharding a crawl across worker processes and hosts.
+
+A coordinator splits a route's look points into shards of consecutive indices and stores them in a SQLite file.
+Workers (local processes, or other hosts that share the filesystem) claim a shard by taking a time-limited lease,
+probe and download its points, and mark it done. A shard whose lease expires, because its worker died or hung,
+is handed to the next worker that asks. Workers write images under their global look-point index, exactly as a
+single-process crawl would, so the usual line-up and render stages work unchanged on the result.
+
+Usage:
+	python3 ./street_crawl.py route lat1 lon1 lat2 lon2 output_filestem
+	python3 ./street_crawl.py enqueue output_filestem --shard-size 100
+	python3 ./street_crawl.py work output_filestem --processes 4    # on as many hosts as you like
+	python3 ./street_crawl.py lineup output_filestem
+'''
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class WorkQueue(object):
+    def __init__(self, db_path, timeout=60):
+        self.db_path = db_path
+        self.timeout = timeout
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY, start INTEGER NOT NULL, "
+                         "stop INTEGER NOT NULL, status TEXT NOT NULL, owner TEXT, lease_expires REAL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, error TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connect(self):
+        # Autocommit mode, so that claims can take the write lock up front with BEGIN IMMEDIATE.
+        return _Connection(sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None))
+
+    def enqueue(self, n_points, shard_size, settings=None):
+        """
+        Split look points 0..n_points-1 into shards of shard_size consecutive indices. Replaces any existing shards.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM shards")
+            conn.executemany("INSERT INTO shards (start, stop, status) VALUES (?, ?, ?)",
+                             [(start, min(start + shard_size, n_points), PENDING)
+                              for start in range(0, n_points, shard_size)])
+            for key, value in (settings or {}).items():
+                conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+            conn.execute("COMMIT")
+
+    def settings(self):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT key, value FROM settings").fetchall())
+
+    def claim(self, worker_id, lease_seconds=300, max_attempts=3):
+        """
+        Lease the first pending shard, or the first shard whose lease has expired.\n
+        An expired shard that has already been attempted max_attempts times (its workers keep dying on it)
+        is marked failed instead of being handed out again.
+        Returns (shard_id, start, stop), or None if nothing is claimable right now.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE shards SET status = ?, lease_expires = NULL, error = ? "
+                         "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                         (FAILED, "lease expired on every attempt", LEASED, now, max_attempts))
+            row = conn.execute("SELECT id, start, stop FROM shards WHERE status = ? OR (status = ? AND lease_expires < ?) "
+                               "ORDER BY id LIMIT 1", (PENDING, LEASED, now)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE shards SET status = ?, owner = ?, lease_expires = ?, attempts = attempts + 1 "
+                             "WHERE id = ?", (LEASED, worker_id, now + lease_seconds, row[0]))
+            conn.execute("COMMIT")
+        return row
+
+    def renew(self, shard_id, worker_id, lease_seconds=300):
+        # Returns False if the lease was lost, i.e. it expired and another worker took the shard.
+        return self._update_owned(shard_id, worker_id, "lease_expires = ?", (time.time() + lease_seconds,))
+
+    def complete(self, shard_id, worker_id):
+        return self._update_owned(shard_id, worker_id, "status = ?, lease_expires = NULL", (DONE,))
+
+    def release(self, shard_id, worker_id, error, max_attempts=3):
+        """
+        Give a shard back after an error. It is retried until it has been attempted max_attempts times, then marked failed.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE shards SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                                  "lease_expires = NULL, error = ? WHERE id = ? AND owner = ? AND status = ?",
+                                  (max_attempts, FAILED, PENDING, str(error), shard_id, worker_id, LEASED))
+            return cursor.rowcount == 1
+
+    def _update_owned(self, shard_id, worker_id, assignments, values):
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE shards SET " + assignments + " WHERE id = ? AND owner = ? AND status = ?",
+                                  values + (shard_id, worker_id, LEASED))
+            return cursor.rowcount == 1
+
+    def progress(self):
+        with self._connect() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM shards GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in [PENDING, LEASED, DONE, FAILED]}
+
+    def is_finished(self):
+        counts = self.progress()
+        return counts[PENDING] == 0 and counts[LEASED] == 0
+
+
+class _Connection(object):
+    # sqlite3's own context manager commits but doesn't close; this one closes.
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+        self.conn.close()
+
+
+def default_worker_id():
+    return "{0}-{1}".format(socket.gethostname(), os.getpid())
+
+
+def streetview_shard_processor(filestem, picsize, threads=DEFAULT_THREADS):
+    """
+    Build a process_shard(start, stop) that probes and downloads one shard of a route saved by the route stage,
+    with up to threads requests at a time.
+    """
+    from config import load_api_keys, load_route
+    from utils import download_images_for_path
+
+    _, api_key_streetview = load_api_keys()
+    look_points = load_route(filestem)
+
+    def process_shard(start, stop):
+        download_images_for_path(api_key_streetview, filestem, look_points, picsize=picsize, indices=range(start, stop),
+                                 threads=threads)
+
+    return process_shard
+
+
+class LeaseKeeper(threading.Thread):
+    """
+    Background thread that renews a shard's lease every lease_seconds / 3 while the shard is being processed.
+    If a renewal fails (the lease expired and another worker took the shard), lost is set and renewing stops.
+    """
+
+    def __init__(self, queue, shard_id, worker_id, lease_seconds):
+        super(LeaseKeeper, self).__init__(daemon=True)
+        self.queue = queue
+        self.shard_id = shard_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = threading.Event()
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.wait(self.lease_seconds / 3.0):
+            if not self.queue.renew(self.shard_id, self.worker_id, self.lease_seconds):
+                self.lost.set()
+                return
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+def run_worker(db_path, process_shard=None, worker_id=None, lease_seconds=300, poll_seconds=5, max_attempts=3,
+               step=10, threads=DEFAULT_THREADS):
+    """
+    Claim and process shards until none are left.\n
+    process_shard(start, stop) does the work; by default it downloads images for the queue's filestem and picsize,
+    threads requests at a time.
+    It is called on step points at a time, and the shard is abandoned between steps if its lease was lost
+    (the lease is renewed in the background while the worker is alive).
+    While other workers still hold leases, keep polling, so that their shards get picked up if they die.
+    Returns the number of shards this worker completed.
+    """
+    queue = WorkQueue(db_path)
+    if worker_id is None:
+        worker_id = default_worker_id()
+    if process_shard is None:
+        settings = queue.settings()
+        process_shard = streetview_shard_processor(settings["filestem"], settings["picsize"], threads)
+    n_done = 0
+    while True:
+        shard = queue.claim(worker_id, lease_seconds, max_attempts)
+        if shard is None:
+            if queue.is_finished():
+                return n_done
+            time.sleep(poll_seconds)
+            continue
+        shard_id, start, stop = shard
+        print("{0}: shard {1} (points {2} to {3})".format(worker_id, shard_id, start, stop - 1))
+        keeper = LeaseKeeper(queue, shard_id, worker_id, lease_seconds)
+        keeper.start()
+        try:
+            for step_start in range(start, stop, step):
+                if keeper.lost.is_set():
+                    break
+                process_shard(step_start, min(step_start + step, stop))
+        except Exception as e:
+            keeper.stop()
+            print("{0}: shard {1} failed: {2}".format(worker_id, shard_id, e))
+            queue.release(shard_id, worker_id, e, max_attempts=max_attempts)
+            continue
+        keeper.stop()
+        if not keeper.lost.is_set() and queue.complete(shard_id, worker_id):
+            n_done += 1
+        else:
+            # Our lease expired and someone else took the shard over. The work is idempotent
+            # (existing files are never re-fetched), so there's nothing to undo.
+            print("{0}: lost the lease on shard {1}".format(worker_id, shard_id))
+
+
+def run_workers(db_path, n_processes, process_shard=None, lease_seconds=300, poll_seconds=5, max_attempts=3, step=10,
+                threads=DEFAULT_THREADS):
+    """
+    Run n_processes local workers on the same queue and wait for them all to finish.
+    """
+    processes = [multiprocessing.Process(target=run_worker,
+                                         args=(db_path, process_shard, None, lease_seconds, poll_seconds, max_attempts,
+                                               step, threads))
+                 for _ in range(n_processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return WorkQueue(db_path).progress()